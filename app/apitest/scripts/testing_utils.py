@@ -6,3 +6,7 @@ def validate_image(response, event_id):
         base_img = f.read()
 
     assert response.content == base_img
+
+
+def validate_no_header(response, header):
+    assert header not in response.headers
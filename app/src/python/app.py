@@ -1,41 +1,134 @@
 import base64
+import hashlib
 import os
 import pathlib
 import subprocess
 import threading
+from datetime import datetime
 
 from flask import (Flask, abort, g, jsonify, make_response, request, send_file,
                    send_from_directory)
 
-import pymysql.cursors
-from utils import utility
+from utils import database, fastjson, hashing, pagination, reservation_queue, schema, seat_counts, utility
+from utils.dbpool import ConnectionPool
+from utils.imagestore import CappedStream, ImageStore, InvalidImageError
+from utils.response_cache import ResponseCache
 from utils.utility import IDNotFoundError
 
 app = Flask(__name__)
 static_folder = str(pathlib.Path('public').resolve())
 
-dbparams = {
-    'host': os.getenv('MYSQL_HOST', '127.0.0.1'),
-    'user': os.getenv('MYSQL_USER'),
-    'password': os.getenv('MYSQL_PASSWORD'),
-    'database': os.getenv('MYSQL_DATABASE'),
-    'cursorclass': pymysql.cursors.DictCursor
-}
-
 app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY', 'da4855bf92b81fafaa170ba2aa9757c4')
 app.config['JSON_AS_ASCII'] = False
 
-lock_for_file_TokenRevocationList = threading.Lock()
-revocation_list_path = os.getenv('REVOCATION_LIST_PATH', 'TokenRevocationList.dat')
+utility.init_revocation_store(database.connect)
+
+pool = ConnectionPool(database.connect,
+                      minsize=int(os.getenv('DB_POOL_MIN_SIZE', '1')),
+                      maxsize=int(os.getenv('DB_POOL_MAX_SIZE', '5')),
+                      timeout=float(os.getenv('DB_POOL_TIMEOUT', '10')),
+                      max_lifetime=float(os.getenv('DB_POOL_MAX_LIFETIME', '3600')),
+                      ping_interval=float(os.getenv('DB_POOL_PING_INTERVAL', '5')))
+
+# 予約をまとめてコミットする場合は RESERVATION_BATCHING=1
+reservation_batcher = None
+if os.getenv('RESERVATION_BATCHING', '0') == '1':
+    reservation_batcher = reservation_queue.ReservationBatcher(
+        database.connect,
+        window=float(os.getenv('RESERVATION_BATCH_WINDOW', '0.003')),
+        max_batch=int(os.getenv('RESERVATION_BATCH_SIZE', '64')),
+        on_sold_out=utility.sold_out_events.mark)
 
 
 def dbh():
     if hasattr(g, 'db'):
         return g.db
-    g.db = pymysql.connect(**dbparams)
+    g.db = pool.acquire()
     return g.db
 
 
+utility.connection_getter = dbh
+hashing.start()
+
+image_store = ImageStore(os.getenv('IMAGE_STORE_PATH', str(pathlib.Path('images').resolve())),
+                         cache_bytes=int(os.getenv('IMAGE_CACHE_BYTES', str(64 * 1024 * 1024))))
+# GET /api/eventsのレスポンス (current_resvを含むので予約の登録・取り消しでも無効化する)
+events_cache = ResponseCache(os.getenv('EVENTS_CACHE_PATH', 'EventsCache.dat'),
+                             ttl=float(os.getenv('EVENTS_CACHE_TTL', '1')),
+                             maxsize=int(os.getenv('EVENTS_CACHE_SIZE', '1024')))
+
+# mysql:5.7のmax_allowed_packet(4MiB)に収まる大きさ (実際の上限はImageStore.max_db_sizeでも抑える)
+image_max_size = int(os.getenv('IMAGE_MAX_SIZE', str(2 * 1024 * 1024)))
+# multipartの区切りやヘッダの分を見込む
+app.config['MAX_CONTENT_LENGTH'] = image_max_size + 64 * 1024
+# 画像のURLは更新されても変わらないので，ブラウザには毎回ETagで確認させる
+image_cache_control = os.getenv('IMAGE_CACHE_CONTROL', 'no-cache')
+
+with open(static_folder + '/img/default.png', 'rb') as f:
+    default_image = f.read()
+default_image_hash = hashlib.sha256(default_image).hexdigest()
+
+
+def setup_db(conn, recheck=False):
+    schema.apply(app, conn, recheck)
+    utility.import_revocation_list(app, conn)
+
+
+# gunicorn.conf.pyでpreloadした場合，マスタープロセスで読み込んだ状態はfork後の各ワーカーと共有される
+shared_state_loaded = False
+# warm_up()を終えたプロセスのpid (GET /api/readyはこれが自身のpidになるまで503を返す)
+ready_pid = None
+warm_up_lock = threading.Lock()
+
+
+def load_shared_state():
+    """マスタープロセスでスキーマを確認し，参照データとタイムスロットを読み込む
+
+    コネクションはプールを使わずに張って閉じる(ワーカーに引き継がない)．
+    """
+    global shared_state_loaded
+
+    conn = database.connect()
+    try:
+        with app.app_context():
+            setup_db(conn)
+            snapshot = utility.reference_data.get(conn)
+            if os.getenv('WARMUP_TIMESLOTS', '1') == '1':
+                utility.timeslot_index.preload(snapshot.venue_ids, conn)
+    finally:
+        conn.close()
+
+    shared_state_loaded = True
+
+
+def warm_up():
+    """ワーカープロセスでコネクションを張り，ハッシュ計算用のプールや失効リストの取得を開始する"""
+    global ready_pid
+
+    with warm_up_lock:
+        if ready_pid == os.getpid():
+            return
+
+        hashing.start()
+        pool.fill()
+        with app.app_context():
+            conn = dbh()
+            if not shared_state_loaded:
+                setup_db(conn)
+            utility.reference_data.get(conn)
+        utility.start_revocation_store()
+
+        ready_pid = os.getpid()
+
+
+@app.before_request
+def warm_up_before_request():
+    # gunicorn.conf.pyのpost_forkで済んでいれば何もしない．失敗した場合は次のリクエストでやり直す
+    # (GET /api/readyは失敗を503で返すため自分で呼ぶ)
+    if ready_pid != os.getpid() and request.endpoint != 'get_ready':
+        warm_up()
+
+
 @app.route('/api/login', methods=['POST'])
 def login():
     if request is None:
@@ -48,14 +141,13 @@ def login():
 
     conn = dbh()
 
-    if utility.is_passwordcorrect(app, username, password, conn) is False:
+    user = utility.authenticate(app, username, password, conn)
+    if user is None:
         return jsonify({"message": "Invalid credentials"}), 401
 
     app.logger.debug("User login: " + username)
 
-    user = utility.get_user_by_username(app, username, conn)
-    user_obj = {'username': user['username'], 'role': user['role']}
-    access_token = utility.create_access_token(user_obj)
+    access_token = utility.create_access_token(user)
     ret = {'user_id': user['id'], 'access_token': access_token}
 
     return jsonify(ret), 200
@@ -66,9 +158,7 @@ def login():
 def logout(t):
     token = request.headers.get("Authorization")
 
-    with lock_for_file_TokenRevocationList:
-        with open(revocation_list_path, 'a') as f:
-            f.write(token.split()[1] + '\n')
+    utility.revoke_token(token.split()[1], dbh())
 
     return "", 200
 
@@ -105,7 +195,7 @@ def signup():
 
             salt = utility.get_salt()
 
-            cursor.execute(query, (username, role, utility.get_passwordhash(salt, password), salt))
+            cursor.execute(query, (username, role, utility.compute_passwordhash(app, salt, password), salt))
 
             conn.commit()
 
@@ -128,13 +218,11 @@ def get_user(token, user_id):
     except ValueError:
         return jsonify({"message": "Invalid input"}), 400
 
-    conn = dbh()
-
-    user = utility.get_user_by_username(app, token['username'], conn)
-
-    if not (user['id'] == user_id or token['role'] == 'owner'):
+    if not (token.user_id == user_id or token.role == 'owner'):
         return jsonify({"message": "Forbidden"}), 403
 
+    conn = dbh()
+
     result = utility.get_user(app, user_id, conn)
 
     if result is None:
@@ -155,18 +243,16 @@ def get_specific_reservations_by_userid(token, user_id):
     except ValueError:
         return jsonify({"message": "Invalid input"}), 400
 
-    conn = dbh()
-
-    username = token["username"]
-    user_obj = utility.get_user_by_username(app, username, conn)
-    role = token['role']
+    role = token.role
 
     if role == "artist":
         return "Forbidden", 403
 
-    if role == "audience" and user_obj['id'] != user_id:
+    if role == "audience" and token.user_id != user_id:
         return "Forbidden", 403
 
+    conn = dbh()
+
     queryparam_limit = request.args.get('limit', 5)
     queryparam_offset = request.args.get('offset', 0)
 
@@ -181,21 +267,30 @@ def get_specific_reservations_by_userid(token, user_id):
             if queryparam_offset < 0:
                 raise ValueError
 
+        use_cursor, after = pagination.get_cursor(request, (int,))
+
     except ValueError:
         return jsonify({"message": "Invalid input"}), 400
 
-    query = 'SELECT * FROM reservations WHERE user_id = %s LIMIT %s OFFSET %s'
-
     with conn.cursor() as cursor:
-        cursor.execute(query, (user_id, queryparam_limit, queryparam_offset))
+        if use_cursor:
+            query = 'SELECT * FROM reservations WHERE user_id = %s AND id > %s ORDER BY id LIMIT %s'
+            cursor.execute(query, (user_id, after[0] if after else 0, queryparam_limit))
+        else:
+            query = 'SELECT * FROM reservations WHERE user_id = %s LIMIT %s OFFSET %s'
+            cursor.execute(query, (user_id, queryparam_limit, queryparam_offset))
         reservations = cursor.fetchall()
 
     if len(reservations) == 0:
         return "Not Found", 404
 
+    next_cursor = None
+    if use_cursor:
+        next_cursor = pagination.next_cursor(reservations, queryparam_limit, lambda r: [r['id']])
+
     resp = utility.generate_reservations_response(app, reservations, conn)
 
-    return jsonify(resp)
+    return pagination.set_next_cursor(fastjson.response(resp), next_cursor)
 
 
 @app.route('/api/events', methods=['GET'])
@@ -214,29 +309,58 @@ def get_events():
             if queryparam_offset < 0:
                 raise ValueError
 
+        # カーソルは最後のイベントの(start_at, id)
+        use_cursor, after = pagination.get_cursor(request, (str, int))
+
+        if user_id is not None:
+            user_id = int(user_id)
+
     except ValueError:
         return jsonify({"message": "Invalid input"}), 400
 
+    # 開始日が今日以降のイベントを返す．start_atはUTCで保存しているのでUTCの日付で区切り，
+    # DBの時計(NOW())は使わずに同じ日付をキャッシュのキーとクエリの両方に使う
+    today = datetime.utcnow().date()
+    cache_key = (today, user_id, queryparam_limit, queryparam_offset, request.args.get('cursor', None))
+    cached = events_cache.get(cache_key)
+    if cached is not None:
+        body, next_cursor = cached
+        return pagination.set_next_cursor(app.response_class(body, mimetype='application/json'), next_cursor), 200
+    generation = events_cache.begin()
+
     conn = dbh()
     query = 'SELECT id, user_id, venue_id, eventgenre_id, name, start_at, end_at, price, created_at,' \
-            ' updated_at FROM `events` WHERE DATE(NOW()) <= start_at'
+            ' updated_at FROM `events` WHERE %s <= start_at'
+    args = [today]
 
     if user_id is not None:
-        try:
-            artist_id = int(user_id)
-        except ValueError:
-            return jsonify({"message": "Invalid input"}), 400
-        query += ' AND user_id = ' + str(artist_id)
-    query += ' LIMIT %s OFFSET %s'
+        query += ' AND user_id = ' + str(user_id)
+
+    if use_cursor:
+        if after is not None:
+            query += ' AND (start_at > %s OR (start_at = %s AND id > %s))'
+            args += [after[0], after[0], after[1]]
+        query += ' ORDER BY start_at, id LIMIT %s'
+        args.append(queryparam_limit)
+    else:
+        query += ' LIMIT %s OFFSET %s'
+        args += [queryparam_limit, queryparam_offset]
 
     try:
         with conn.cursor() as cursor:
-            cursor.execute(query, (queryparam_limit, queryparam_offset,))
+            cursor.execute(query, args)
             events = cursor.fetchall()
 
+        next_cursor = None
+        if use_cursor:
+            next_cursor = pagination.next_cursor(events, queryparam_limit, lambda e: [str(e['start_at']), e['id']])
+
         resp = utility.generate_events_response(app, events, conn)
 
-        return jsonify(resp), 200
+        response = fastjson.response(resp)
+        events_cache.set(cache_key, (response.get_data(), next_cursor), generation)
+
+        return pagination.set_next_cursor(response, next_cursor), 200
 
     except Exception as e:
         app.logger.exception(e)
@@ -247,12 +371,10 @@ def get_events():
 @utility.jwt_required
 def post_events(token):
 
-    username = token["username"]
-    role = token['role']
+    role = token.role
 
     conn = dbh()
-    user_obj = utility.get_user_by_username(app, username, conn)
-    req_artist_id = user_obj['id']
+    req_artist_id = token.user_id
 
     if role == "audience" or role == "owner":
         return jsonify({"message": "Forbidden"}), 403
@@ -314,7 +436,7 @@ def post_events(token):
     except TypeError:
         return jsonify({"message": "Invalid input"}), 400
 
-    if role == "artist" and user_obj['id'] != req_artist_id:
+    if role == "artist" and token.user_id != req_artist_id:
         return jsonify({"message": "Forbidden"}), 403
 
     event_id = 0
@@ -338,12 +460,9 @@ def post_events(token):
 
             event_id = cursor.lastrowid
 
-            for req_timeslot_id in req_timeslot_ids:
-                query = "UPDATE timeslots SET event_id=%s WHERE id=%s AND event_id is NULL"
-                cursor.execute(query, (event_id, req_timeslot_id))
+            seat_counts.ensure(cursor, [event_id])
 
-                if cursor.rowcount != 1:
-                    raise utility.DuplicatedError
+            utility.claim_timeslots(event_id, req_timeslot_ids, cursor)
 
             conn.commit()
 
@@ -363,10 +482,13 @@ def post_events(token):
         app.logger.exception(e)
         abort(500)
 
+    events_cache.invalidate()
+    utility.timeslot_index.invalidate([timeslots[0]['venue_id']])
+
     event = utility.get_event_by_id(app, event_id, conn)
     event_detail = utility.generate_events_response(app, [event], conn)[0]
 
-    return jsonify(event_detail), 201
+    return fastjson.response(event_detail), 201
 
 
 @app.route('/api/events/<event_id>', methods=['GET'])
@@ -394,17 +516,15 @@ def get_events_specific(event_id):
 
     event_detail = utility.generate_events_response(app, [event], conn)[0]
 
-    return jsonify(event_detail), 200
+    return fastjson.response(event_detail), 200
 
 
 @app.route('/api/events/<event_id>', methods=['PUT'])
 @utility.jwt_required
 def update_events(token, event_id):
-    username = token["username"]
-    role = token["role"]
+    role = token.role
 
     conn = dbh()
-    user_obj = utility.get_user_by_username(app, username, conn)
 
     content_type = request.headers.get("Content-Type")
     if content_type is None or content_type != 'application/json':
@@ -418,7 +538,7 @@ def update_events(token, event_id):
         req_price = int(request.json.get('price', None))
         req_start_at = request.json.get('start_at', '')
         req_end_at = request.json.get('end_at', '')
-        req_artist_id = user_obj['id']
+        req_artist_id = token.user_id
         req_event_id = int(event_id)
 
         # timeslots_idsがリストでは無い，または空，もしくは3つ以上だった場合
@@ -479,7 +599,7 @@ def update_events(token, event_id):
     if role == "audience":
         return jsonify({"message": "Forbidden"}), 403
     elif role == "artist":
-        if user_obj['id'] != event['user_id']:
+        if token.user_id != event['user_id']:
             return jsonify({"message": "Forbidden"}), 403
 
     try:
@@ -504,12 +624,7 @@ def update_events(token, event_id):
                 raise Exception
 
             # update new timeslot
-            for req_timeslot_id in req_timeslot_ids:
-                query = "UPDATE timeslots SET event_id=%s WHERE id=%s AND event_id is NULL"
-                cursor.execute(query, (req_event_id, req_timeslot_id, ))
-
-                if cursor.rowcount != 1:
-                    raise utility.DuplicatedError
+            utility.claim_timeslots(req_event_id, req_timeslot_ids, cursor)
 
             conn.commit()
 
@@ -530,10 +645,13 @@ def update_events(token, event_id):
         app.logger.exception(e)
         abort(500)
 
+    events_cache.invalidate()
+    utility.timeslot_index.invalidate([event['venue_id'], timeslots[0]['venue_id']])
+
     event = utility.get_event_by_id(app, event_id, conn)
     event_detail = utility.generate_events_response(app, [event], conn)[0]
 
-    return jsonify(event_detail), 200
+    return fastjson.response(event_detail), 200
 
 
 @app.route('/api/events/<event_id>/image', methods=['GET'])
@@ -545,21 +663,59 @@ def get_images(event_id):
 
     conn = dbh()
 
+    image_hash, icon = get_event_image(event_id, conn)
+    if image_hash is None:
+        return jsonify({"message": "Not Found"}), 404
+
+    if request.if_none_match.contains(image_hash):
+        response = make_response('', 304)
+    else:
+        path = None
+        if icon is None:
+            icon, path = image_store.load(image_hash, conn)
+        if icon is None and path is None:
+            icon = default_image
+
+        if path is not None:
+            # キャッシュに載らない大きさの画像はwsgi.file_wrapper(sendfile)でそのまま返す
+            response = send_file(path, mimetype='image/png', conditional=False)
+        else:
+            response = make_response(icon)
+            response.headers.set('Content-Type', 'image/png')
+
+    response.set_etag(image_hash)
+    response.headers.set('Cache-Control', image_cache_control)
+    return response
+
+
+def get_event_image(event_id, conn):
+    """(画像のハッシュ, 画像のバイト列)を返す．バイト列がNoneの場合はimage_storeから読む．イベントが無ければ(None, None)
+
+    PUTの直後に他のワーカーが古い画像を返さないよう，ハッシュは毎回(主キーで)引く．
+    """
     with conn.cursor() as cursor:
-        query = 'SELECT image FROM events WHERE id = %s'
+        query = 'SELECT image_hash, image IS NOT NULL AS has_image FROM events WHERE id = %s'
         cursor.execute(query, (event_id,))
 
         event = cursor.fetchone()
 
         if event is None:
-            return jsonify({"message": "Not Found"}), 404
-        elif event['image'] is None:
-            return send_file(str(static_folder) + '/img/default.png', mimetype='image/png')
+            return None, None
 
-        icon = base64.b64decode(event['image'])
-        response = make_response(icon)
-        response.headers.set('Content-Type', 'image/png')
-    return response
+        if event['has_image'] and event['image_hash'] is None:
+            # 移行前のbase64の画像
+            query = 'SELECT image FROM events WHERE id = %s'
+            cursor.execute(query, (event_id,))
+
+            icon = base64.b64decode(cursor.fetchone()['image'])
+            return hashlib.sha256(icon).hexdigest(), icon
+
+    if event['image_hash'] is None:
+        image_hash, icon = default_image_hash, default_image
+    else:
+        image_hash, icon = event['image_hash'], None
+
+    return image_hash, icon
 
 
 @app.route('/api/events/<event_id>/image', methods=['PUT'])
@@ -570,10 +726,17 @@ def put_images(token, event_id):
     if content_types is None or content_types[0] != 'multipart/form-data':
         return jsonify({"message": "Invalid input"}), 400
 
+    # multipartを解析する前に，明らかに大きすぎる本文は断る
+    if request.content_length is not None and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({"message": "Invalid input"}), 400
+    if request.content_length is None:
+        # Content-Lengthの無い(chunkedの)本文はWerkzeugが大きさを確かめないので，読んだ量を数える
+        request.environ['wsgi.input'] = CappedStream(request.environ['wsgi.input'],
+                                                     app.config['MAX_CONTENT_LENGTH'])
+
     conn = dbh()
 
-    role = token['role']
-    login_user = utility.get_user_by_username(app, token['username'], conn)
+    role = token.role
 
     try:
         event_id = int(event_id)
@@ -582,6 +745,8 @@ def put_images(token, event_id):
         return jsonify({"message": "Invalid input"}), 400
     except KeyError:
         return jsonify({"message": "Invalid input"}), 400
+    except InvalidImageError:
+        return jsonify({"message": "Invalid input"}), 400
 
     if role == "audience":
         return jsonify({"message": "Forbiddon"}), 403
@@ -589,23 +754,34 @@ def put_images(token, event_id):
     if request.files['image'].content_type != 'image/png':
         return jsonify({"message": "Invalid input"}), 400
 
-    image_string = base64.b64encode(file.read())
-
     with conn.cursor() as cursor:
-        query = 'SELECT * FROM events WHERE id = %s'
+        query = 'SELECT user_id FROM events WHERE id = %s'
         cursor.execute(query, (event_id,))
 
         event = cursor.fetchone()
 
         if event is None:
             return jsonify({"message": "Not found"}), 404
-        elif event['user_id'] != login_user['id'] and token['role'] != "owner":
+        elif event['user_id'] != token.user_id and token.role != "owner":
             return jsonify({"message": "Forbidden"}), 403
 
-        query = "UPDATE events SET image=%s WHERE id=%s"
-        cursor.execute(query, (image_string, event_id))
+        try:
+            image_hash = image_store.put_stream(file.stream, cursor, image_max_size)
+
+            query = "UPDATE events SET image_hash=%s, image=NULL WHERE id=%s"
+            cursor.execute(query, (image_hash, event_id))
+
+            conn.commit()
+
+        except InvalidImageError:
+            conn.rollback()
+            return jsonify({"message": "Invalid input"}), 400
+
+        except Exception as e:
+            conn.rollback()
+            app.logger.exception(e)
+            abort(500)
 
-        conn.commit()
         return "", 204
 
 
@@ -627,10 +803,12 @@ def get_reservations(token, event_id):
             if queryparam_offset < 0:
                 raise ValueError
 
+        use_cursor, after = pagination.get_cursor(request, (int,))
+
     except ValueError:
         return jsonify({"message": "Invalid input"}), 400
 
-    if token['role'] == 'audience':
+    if token.role == 'audience':
         return jsonify({"message": "Forbidden"}), 403
 
     # path param check
@@ -647,34 +825,38 @@ def get_reservations(token, event_id):
     if event is None:
         return jsonify({"message": "Not Found"}), 404
 
-    login_user = utility.get_user_by_username(app, token['username'], conn)
-
-    if token['role'] == "audience":
+    if token.role == "audience":
         return jsonify({"message": "Forbidden"}), 403
 
-    if token['role'] == 'artist':
-        if event['user_id'] != login_user['id']:
+    if token.role == 'artist':
+        if event['user_id'] != token.user_id:
             return jsonify({"message": "Forbidden"}), 403
 
-    reservations = utility.get_reservations_by_eventid(
-        app, event_id, conn, queryparam_offset, queryparam_limit)
+    if use_cursor:
+        reservations = utility.get_reservations_by_eventid(
+            app, event_id, conn, None, queryparam_limit, after[0] if after else None)
+    else:
+        reservations = utility.get_reservations_by_eventid(
+            app, event_id, conn, queryparam_offset, queryparam_limit)
 
     if reservations is None or len(reservations) == 0:
         return jsonify(list()), 200
 
+    next_cursor = None
+    if use_cursor:
+        next_cursor = pagination.next_cursor(reservations, queryparam_limit, lambda r: [r['id']])
+
     resp = utility.generate_reservations_response(app, reservations, conn)
 
-    return jsonify(resp), 200
+    return pagination.set_next_cursor(fastjson.response(resp), next_cursor), 200
 
 
 @app.route('/api/reservations/<resv_id>', methods=['GET'])
 @utility.jwt_required
 def get_specific_reservations_by_eventid_and_resvid(token, resv_id):
-    username = token["username"]
-    role = token["role"]
+    role = token.role
 
     conn = dbh()
-    user_obj = utility.get_user_by_username(app, username, conn)
 
     # check 400 error
     try:
@@ -691,24 +873,21 @@ def get_specific_reservations_by_eventid_and_resvid(token, resv_id):
     if reservation is None:
         return jsonify({"message": "Not Found"}), 404
 
-    if role == "audience" and reservation['user_id'] != user_obj['id']:
+    if role == "audience" and reservation['user_id'] != token.user_id:
         return jsonify({"message": "Forbidden"}), 403
 
     resp = utility.generate_reservations_response(app, [reservation], conn)[0]
 
-    return jsonify(resp)
+    return fastjson.response(resp)
 
 
 @app.route('/api/reservations/<reservation_id>', methods=['DELETE'])
 @utility.jwt_required
 def delete_resv(token, reservation_id):
-    username = token["username"]
-
     conn = dbh()
-    user_obj = utility.get_user_by_username(app, username, conn)
 
-    role = token["role"]
-    user_id = user_obj["id"]
+    role = token.role
+    user_id = token.user_id
 
     # check 400 error
     try:
@@ -730,18 +909,8 @@ def delete_resv(token, reservation_id):
     if role == "audience" and reservation['user_id'] != user_id:
         return jsonify({"message": "Forbidden"}), 403
 
-    try:
-        with conn.cursor() as cursor:
-
-            query = "DELETE FROM reservations WHERE id=%s"
-
-            cursor.execute(query, reservation_id)
-
-            conn.commit()
-
-    except Exception as e:
-        app.logger.exception(e)
-        abort(500)
+    utility.cancel_reservation(app, reservation_id, conn)
+    events_cache.invalidate()
 
     return "", 204
 
@@ -757,15 +926,13 @@ def post_reservation(token, event_id):
     if content_type is None or content_type != 'application/json':
         return jsonify({"message": "Invalid input"}), 400
 
-    username = token["username"]
-    role = token['role']
+    role = token.role
 
     conn = dbh()
-    user_obj = utility.get_user_by_username(app, username, conn)
 
     # request body check
     try:
-        req_user_id = user_obj['id']
+        req_user_id = token.user_id
         req_event_id = int(event_id)
         req_num_of_resv = int(request.json.get('num_of_resv', None))
 
@@ -790,84 +957,57 @@ def post_reservation(token, event_id):
     if role != "audience":
         return jsonify({"message": "Forbidden"}), 403
 
-    if req_user_id != user_obj['id']:
+    if req_user_id != token.user_id:
         return jsonify({"message": "Forbidden"}), 403
 
+    if utility.sold_out_events.is_sold_out(req_event_id):
+        # 予約済みのユーザには売り切れより先に重複予約を返す(reserveと同じ順)
+        if utility.has_reservation(app, req_user_id, req_event_id, conn):
+            return jsonify({"message": "User has already reserved"}), 409
+        return jsonify({"message": "Sold out the ticket"}), 409
+
     event = utility.get_event_by_id(app, req_event_id, conn)
     if event is None:
         return jsonify({"message": "Not Found"}), 404
 
     venue = utility.get_venue_by_id(app, event['venue_id'], conn)
 
-    new_resv_id = 0
-    try:
-        with conn.cursor() as cursor:
-
-            conn.begin()
-
-            query = 'LOCK TABLE reservations WRITE'
-            cursor.execute(query,)
-
-            # if user has already reserved
-            query = 'SELECT * FROM reservations WHERE event_id = %s and user_id = %s'
-            cursor.execute(query, (req_event_id, user_obj['id'],))
-
-            if cursor.rowcount >= 1:
-                return jsonify({"message": "User has already reserved"}), 409
-
-            # get current resv
-            query = 'SELECT * FROM reservations WHERE event_id = %s'
-            cursor.execute(query, (req_event_id,))
-
-            results = cursor.fetchall()
-
-            curret_resv = 0
-
-            for result in results:
-                curret_resv += result['num_of_resv']
-
-            # Will the capacity be exceeded by this booking?
-            if req_num_of_resv + curret_resv > venue['capacity']:
-                return jsonify({"message": "Sold out the ticket"}), 409
-
-            query = "INSERT INTO reservations(user_id, event_id, num_of_resv)" + \
-                    " VALUES(%s, %s, %s)"
-
-            cursor.execute(query, (req_user_id, req_event_id, req_num_of_resv,))
-
-            if cursor.rowcount != 1:
-                query = 'UNLOCK TABLES'
-                cursor.execute(query, )
-                raise Exception
+    if reservation_batcher is not None:
+        try:
+            status, new_resv_id = reservation_batcher.submit(req_user_id, req_event_id, req_num_of_resv,
+                                                             venue['capacity'])
+        except Exception as e:
+            app.logger.exception(e)
+            abort(500)
+    else:
+        status, new_resv_id = utility.reserve(app, req_user_id, req_event_id, req_num_of_resv,
+                                              venue['capacity'], conn)
 
-            new_resv_id = cursor.lastrowid
+    if status == reservation_queue.ALREADY_RESERVED:
+        return jsonify({"message": "User has already reserved"}), 409
 
-            conn.commit()
-            query = 'UNLOCK TABLES'
-            cursor.execute(query, )
+    if status == reservation_queue.SOLD_OUT:
+        return jsonify({"message": "Sold out the ticket"}), 409
 
-    except Exception as e:
-        app.logger.exception(e)
-        abort(500)
+    events_cache.invalidate()
 
     reservation = utility.get_reservation_by_id(app, new_resv_id, conn)
     resp = utility.generate_reservations_response(app, [reservation], conn)[0]
 
-    return jsonify(resp), 201
+    return fastjson.response(resp), 201
 
 
 @app.route('/api/genres', methods=['GET'])
 @utility.jwt_required
 def get_genres(token):
-    role = token['role']
+    role = token.role
 
     if role == "audience":
         return jsonify({"message": "Forbidden"}), 403
 
     conn = dbh()
 
-    results = utility.get_genres(app, conn)
-    return jsonify(results), 200
+    return app.response_class(utility.get_genres(app, conn), mimetype='application/json'), 200
 
 
 @app.route('/api/venues', methods=['GET'])
@@ -887,13 +1027,20 @@ def get_venues(token):
             if queryparam_offset < 0:
                 raise ValueError
 
+        use_cursor, after = pagination.get_cursor(request, (int,))
+
     except ValueError:
         return jsonify({"message": "Invalid input"}), 400
 
     conn = dbh()
 
-    records = utility.get_venues(app, conn, queryparam_offset, queryparam_limit)
-    return jsonify(records), 200
+    if use_cursor:
+        body, venue_ids = utility.get_venues(app, conn, None, queryparam_limit, after[0] if after else None)
+        next_cursor = pagination.next_cursor(venue_ids, queryparam_limit, lambda venue_id: [venue_id])
+        return pagination.set_next_cursor(app.response_class(body, mimetype='application/json'), next_cursor), 200
+
+    body, _ = utility.get_venues(app, conn, queryparam_offset, queryparam_limit)
+    return app.response_class(body, mimetype='application/json'), 200
 
 
 @app.route('/api/venues/<venue_id>/timeslots', methods=['GET'])
@@ -925,7 +1072,7 @@ def get_venue_timeslots(token, venue_id):
         if venue is None:
             return jsonify({"message": "Not Found"}), 404
 
-        role = token['role']
+        role = token.role
 
         if role == "audience":
             return jsonify({"message": "Forbidden"}), 403
@@ -939,14 +1086,44 @@ def get_venue_timeslots(token, venue_id):
     if records is None or len(records) == 0:
         records = []
 
-    return jsonify(records)
+    return fastjson.response(records)
 
 
-@app.after_request
-def after_request_func(response):
-    if hasattr(g, 'db'):
-        dbh().close()
-    return response
+@app.route('/api/ready', methods=['GET'])
+def get_ready():
+    # このワーカーの準備が終わっていなければ準備を試み，失敗したら503を返す
+    if ready_pid != os.getpid():
+        try:
+            warm_up()
+        except Exception as e:
+            app.logger.exception(e)
+
+    ready = ready_pid == os.getpid()
+    return jsonify({'ready': ready, 'pid': os.getpid(), 'preloaded': shared_state_loaded}), 200 if ready else 503
+
+
+@app.route('/api/stats', methods=['GET'])
+@utility.jwt_required
+def get_stats(token):
+    # 内部の状態を含むのでownerにだけ返す
+    if token.role != "owner":
+        return jsonify({"message": "Forbidden"}), 403
+
+    stats = utility.get_cache_stats()
+    stats['db_pool'] = pool.stats()
+    stats['image'] = image_store.cache.stats()
+    stats['events_response'] = events_cache.stats()
+    if reservation_batcher is not None:
+        stats['reservation_batch'] = reservation_batcher.stats()
+    return jsonify(stats), 200
+
+
+@app.teardown_appcontext
+def teardown_func(exception):
+    # abort(500)や例外で終わった場合もコネクションをプールに返す
+    conn = g.pop('db', None)
+    if conn is not None:
+        pool.release(conn)
 
 
 @app.route('/')
@@ -965,6 +1142,17 @@ def initialize():
     if res != 0:
         abort(500)
 
+    conn = dbh()
+    setup_db(conn, recheck=True)
+    # init.shでreservationsが入れ替わるため予約数を数え直す
+    seat_counts.repair(conn)
+    utility.sold_out_events.release()
+    # usersが入れ替わるので，以前のログインやusernameとuser_idの対応は全ワーカーで捨てる
+    utility.clear_user_caches()
+    events_cache.invalidate()
+    utility.reference_data.invalidate(conn)
+    utility.timeslot_index.invalidate()
+
     # 販促実施に応じて，ここの値を変更してください
     # 詳しくは，specを参照してください．
     # https://portal.ptc.ntt.dev/spec.html#tag/other
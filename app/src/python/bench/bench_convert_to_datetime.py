@@ -0,0 +1,89 @@
+"""convert_to_datetime の変換結果の確認とレイテンシの計測
+
+CORPUSの各文字列が期待するUTCのnaiveなdatetimeに変換されることを確認し，
+iso8601.parse_dateだけを使っていた以前の実装と比較する．DBは使わない．
+
+    $ cd app/src/python && python bench/bench_convert_to_datetime.py
+"""
+from datetime import datetime
+
+import iso8601
+
+from helpers import timeit
+from utils import utility
+
+# (入力, 期待する結果) 結果がNoneのものは不正な入力
+CORPUS = [
+    ('2020-11-01T10:00:00Z', datetime(2020, 11, 1, 10, 0, 0)),
+    ('2020-11-01T10:00:00.123Z', datetime(2020, 11, 1, 10, 0, 0, 123000)),
+    ('2020-11-01T10:00:00.123456Z', datetime(2020, 11, 1, 10, 0, 0, 123456)),
+    ('2020-11-01T10:00:00', datetime(2020, 11, 1, 10, 0, 0)),
+    ('2020-11-01 10:00:00', datetime(2020, 11, 1, 10, 0, 0)),
+    ('2020-11-01T10:00Z', datetime(2020, 11, 1, 10, 0, 0)),
+    ('2020-11-01', datetime(2020, 11, 1, 0, 0, 0)),
+    ('2020-11-01T10:00:00+00:00', datetime(2020, 11, 1, 10, 0, 0)),
+    ('2020-11-01T10:00:00+09:00', datetime(2020, 11, 1, 1, 0, 0)),
+    ('2020-11-01T08:00:00+09:00', datetime(2020, 10, 31, 23, 0, 0)),
+    ('2020-11-01T10:00:00+05:30', datetime(2020, 11, 1, 4, 30, 0)),
+    ('2020-11-01T10:00:00-06:00', datetime(2020, 11, 1, 16, 0, 0)),
+    ('2020-12-31T20:00:00-05:00', datetime(2021, 1, 1, 1, 0, 0)),
+    # fromisoformatでは解釈できずiso8601にフォールバックする表記
+    ('2020-11-01T10:00:00.1Z', datetime(2020, 11, 1, 10, 0, 0, 100000)),
+    ('2020-11-01T10:00:00+0900', datetime(2020, 11, 1, 1, 0, 0)),
+    ('2020-11-01T10:00:00.123456789Z', datetime(2020, 11, 1, 10, 0, 0, 123456)),
+    ('20201101T100000Z', datetime(2020, 11, 1, 10, 0, 0)),
+    # 不正な入力
+    ('', None),
+    ('2020-13-01T10:00:00Z', None),
+    ('2020-11-01X10:00:00Z', None),
+    ('not a date', None),
+]
+
+
+def convert_to_datetime_before(time):
+    # 以前の実装 (負のオフセットは逆向きにずれ，'-'を含まない表記では例外になる)
+    try:
+        res = iso8601.parse_date(time)
+    except Exception:
+        return None
+
+    if '+' in time:
+        return (res - res.utcoffset()).replace(tzinfo=None)
+    elif '-' in time:
+        return (res + res.utcoffset()).replace(tzinfo=None)
+    else:
+        return res.utcoffset().replace(tzinfo=None)
+
+
+def main():
+    failures = 0
+    for text, expected in CORPUS:
+        actual = utility.convert_to_datetime(text)
+        if actual != expected:
+            failures += 1
+            print('NG {!r}: expected={} actual={}'.format(text, expected, actual))
+
+        try:
+            before = convert_to_datetime_before(text)
+        except Exception as e:
+            before = type(e).__name__
+        if before != actual:
+            print('changed {!r}: before={} after={}'.format(text, before, actual))
+
+    print('{}/{} passed'.format(len(CORPUS) - failures, len(CORPUS)))
+
+    inputs = [text for text, expected in CORPUS if expected is not None and '-' in text] * 100
+    before_latency = timeit(lambda: [convert_to_datetime_before(text) for text in inputs])
+    utility.parse_datetime.cache_clear()
+    uncached_latency = timeit(lambda: [utility.parse_datetime.__wrapped__(text) for text in inputs])
+    after_latency = timeit(lambda: [utility.convert_to_datetime(text) for text in inputs])
+
+    print('{:>6} {:>12} {:>16} {:>12}'.format('inputs', 'before [ms]', 'no memo [ms]', 'after [ms]'))
+    print('{:>6} {:>12.2f} {:>16.2f} {:>12.2f}'.format(len(inputs), before_latency * 1000, uncached_latency * 1000,
+                                                       after_latency * 1000))
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,70 @@
+"""GET /api/events 1000件分のレスポンスのエンコード時間の計測
+
+以前の実装(各行のdatetimeをconvert_to_iso8601で書き換えてからjsonify)と
+fastjson.dumpsを比較し，出力が同じバイト列であることも確認する．DBは使わない．
+
+    $ cd app/src/python && python bench/bench_json_encoding.py
+"""
+import copy
+from datetime import datetime, timedelta
+
+from flask import Flask, jsonify
+
+from helpers import timeit
+from utils import fastjson, utility
+
+app = Flask(__name__)
+app.config['JSON_AS_ASCII'] = False
+
+
+def make_events(n):
+    base = datetime(2020, 11, 1, 10, 0, 0)
+    events = []
+    for i in range(n):
+        start_at = base + timedelta(hours=i)
+        events.append({'id': i + 1,
+                       'venue_id': i % 20 + 1,
+                       'price': 1000 + i,
+                       'start_at': start_at,
+                       'end_at': start_at + timedelta(hours=2),
+                       'created_at': base - timedelta(days=1, microseconds=i),
+                       'updated_at': base - timedelta(days=1),
+                       'artist_id': i % 100 + 1,
+                       'artist_name': 'アーティスト{}'.format(i % 100),
+                       'event_name': '公演 "{}" \\ テスト\n'.format(i),
+                       'event_genre_id': i % 5 + 1,
+                       'venue_name': '会場{}'.format(i % 20),
+                       'capacity': 500,
+                       'current_resv': i % 500,
+                       'timeslot_ids': [i * 2 + 1, i * 2 + 2]})
+    return events
+
+
+def encode_before(events):
+    for event in events:
+        for key in ('start_at', 'end_at', 'created_at', 'updated_at'):
+            event[key] = utility.convert_to_iso8601(event[key])
+    return jsonify(events).get_data()
+
+
+def main():
+    events = make_events(1000)
+
+    with app.app_context():
+        before = encode_before(copy.deepcopy(events))
+        after = fastjson.dumps(events)
+        assert before == after
+
+        # 以前の実装は行を書き換えるので，コピーの時間を差し引く
+        copy_latency = timeit(lambda: copy.deepcopy(events))
+        before_latency = timeit(lambda: encode_before(copy.deepcopy(events))) - copy_latency
+        after_latency = timeit(lambda: fastjson.dumps(events))
+
+    print('backend: {}'.format('orjson' if fastjson.orjson is not None else 'json'))
+    print('{:>6} {:>8} {:>12} {:>12}'.format('events', 'bytes', 'before [ms]', 'after [ms]'))
+    print('{:>6} {:>8} {:>12.2f} {:>12.2f}'.format(len(events), len(after), before_latency * 1000,
+                                                   after_latency * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""パスワードハッシュ計算のスループット計測
+
+gunicorn -w 5 --thread 5 の1ワーカー内で，ログインが同時にN件来た状況を模擬する．
+inline(リクエストスレッドで計算)とprocess(プロセスプールで計算)で，
+スレッド数を増やしたときのスループットを比較する．
+
+    $ cd app/src/python && python bench/bench_passwordhash.py
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utils import hashing  # noqa: E402
+from utils.utility import get_passwordhash, get_salt  # noqa: E402
+
+REQUESTS = 500
+
+
+def login(salt):
+    return hashing.run(get_passwordhash, salt, 'password')
+
+
+def measure(threads, salt):
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        begin = time.perf_counter()
+        list(pool.map(login, [salt] * REQUESTS))
+        return REQUESTS / (time.perf_counter() - begin)
+
+
+def main():
+    salt = get_salt()
+
+    print('cpu_count={} requests={}'.format(os.cpu_count(), REQUESTS))
+    print('{:>7} {:>14} {:>14}'.format('threads', 'inline [req/s]', 'process [req/s]'))
+
+    for threads in range(1, 6):
+        hashing.enabled = False
+        inline = measure(threads, salt)
+
+        hashing.enabled = True
+        hashing.start()
+        measure(threads, salt)  # プールのウォームアップ
+        process = measure(threads, salt)
+        hashing.shutdown()
+
+        print('{:>7} {:>14.1f} {:>14.1f}'.format(threads, inline, process))
+
+
+if __name__ == '__main__':
+    main()
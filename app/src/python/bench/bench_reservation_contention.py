@@ -0,0 +1,144 @@
+"""予約処理のロック競合の計測
+
+複数スレッドが複数イベントに同時に予約したときのスループットを，
+以前の LOCK TABLE reservations WRITE による実装，イベント行をロックして合計を数える実装と，
+現在の実装(utility.reserve: event_seat_countsの条件付きUPDATE)とで比較する．
+挿入した予約は計測後に削除し，予約数のカウンタも戻す．
+
+    $ cd app/src/python && python bench/bench_reservation_contention.py [threads] [events] [seconds]
+"""
+import sys
+import threading
+import time
+
+import pymysql
+
+from helpers import DummyApp, connect
+from utils import reservation_queue, seat_counts, utility
+
+
+def reserve_with_table_lock(conn, event_id, user_id, capacity):
+    # 以前の実装
+    with conn.cursor() as cursor:
+        conn.begin()
+        cursor.execute('LOCK TABLE reservations WRITE')
+        try:
+            cursor.execute('SELECT * FROM reservations WHERE event_id = %s and user_id = %s', (event_id, user_id))
+            if cursor.rowcount >= 1:
+                conn.rollback()
+                return None
+
+            cursor.execute('SELECT * FROM reservations WHERE event_id = %s', (event_id,))
+            if 1 + sum(r['num_of_resv'] for r in cursor.fetchall()) > capacity:
+                conn.rollback()
+                return None
+
+            cursor.execute('INSERT INTO reservations(user_id, event_id, num_of_resv) VALUES(%s, %s, 1)',
+                           (user_id, event_id))
+            resv_id = cursor.lastrowid
+            conn.commit()
+            return resv_id
+        finally:
+            cursor.execute('UNLOCK TABLES')
+
+
+def reserve_with_row_lock(conn, event_id, user_id, capacity):
+    # event_seat_countsを導入する前の実装
+    with conn.cursor() as cursor:
+        conn.begin()
+        cursor.execute('SELECT id FROM events WHERE id = %s FOR UPDATE', (event_id,))
+        try:
+            cursor.execute('INSERT INTO reservations(user_id, event_id, num_of_resv) VALUES(%s, %s, 1)',
+                           (user_id, event_id))
+        except pymysql.err.IntegrityError:
+            conn.rollback()
+            return None
+        resv_id = cursor.lastrowid
+
+        cursor.execute('SELECT COALESCE(SUM(num_of_resv), 0) AS current_resv FROM reservations WHERE event_id = %s',
+                       (event_id,))
+        if cursor.fetchone()['current_resv'] > capacity:
+            conn.rollback()
+            return None
+
+        conn.commit()
+        return resv_id
+
+
+def reserve_with_counter(conn, event_id, user_id, capacity):
+    # app.post_reservationと同じ手順 (RESERVATION_BATCHING=0の場合)
+    status, resv_id = utility.reserve(DummyApp, user_id, event_id, 1, capacity, conn)
+    return resv_id if status == reservation_queue.RESERVED else None
+
+
+def run(reserve, events, users, threads, seconds, counted=False):
+    inserted = []
+    counts = [0] * threads
+
+    def worker(i):
+        conn = connect()
+        my_users = users[i::threads]
+        deadline = time.perf_counter() + seconds
+        n = 0
+        while time.perf_counter() < deadline:
+            # (イベント, ユーザ)の組が重複しないように回す
+            event_id, capacity = events[n % len(events)]
+            user_id = my_users[(n // len(events)) % len(my_users)]
+            resv_id = reserve(conn, event_id, user_id, capacity)
+            if resv_id is not None:
+                inserted.append((resv_id, event_id))
+            n += 1
+        counts[i] = n
+        conn.close()
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    conn = connect()
+    with conn.cursor() as cursor:
+        for i in range(0, len(inserted), 1000):
+            ids = [resv_id for resv_id, _ in inserted[i:i + 1000]]
+            cursor.execute('DELETE FROM reservations WHERE id IN ({})'.format(', '.join(['%s'] * len(ids))), ids)
+
+        if counted:
+            for event_id, _ in events:
+                n = sum(1 for _, e in inserted if e == event_id)
+                if n:
+                    seat_counts.add(cursor, event_id, -n)
+    conn.commit()
+    conn.close()
+
+    return sum(counts) / seconds
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    n_events = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+    conn = connect()
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT e.id, v.capacity FROM events e JOIN venues v ON v.id = e.venue_id'
+                       ' ORDER BY v.capacity DESC LIMIT %s', (n_events,))
+        events = [(r['id'], r['capacity']) for r in cursor.fetchall()]
+
+        # まだ予約していないユーザだけを使う
+        cursor.execute("SELECT id FROM users WHERE role = 'audience' AND id NOT IN"
+                       " (SELECT user_id FROM reservations WHERE event_id IN ({}))".format(
+                           ', '.join(['%s'] * len(events))), [e[0] for e in events])
+        users = [r['id'] for r in cursor.fetchall()]
+    conn.close()
+
+    print('threads={} events={} seconds={}'.format(threads, len(events), seconds))
+    strategies = (('LOCK TABLE', reserve_with_table_lock, False),
+                  ('row lock', reserve_with_row_lock, False),
+                  ('counter', reserve_with_counter, True))
+    for name, reserve, counted in strategies:
+        print('{:>10}: {:8.1f} req/s'.format(name, run(reserve, events, users, threads, seconds, counted)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""generate_reservations_response のクエリ数とレイテンシの計測
+
+予約の多いイベントについて limit=10, 100, 1000 のページを生成し，
+予約ごとにユーザ・イベント・会場を引いていた以前の実装と比較する．
+
+    $ cd app/src/python && python bench/bench_reservations_response.py
+"""
+import copy
+
+from helpers import CountingConnection, DummyApp, connect, timeit
+from utils import fastjson, utility
+
+app = DummyApp()
+
+
+def generate_reservations_response_per_row(app, reservations, conn):
+    # 以前の実装(予約1件ごとに3クエリ)
+    response = []
+    for reservation in reservations:
+        reservation['username'] = utility.get_user(app, reservation['user_id'], conn)['username']
+        event = utility.get_event_by_id(app, reservation['event_id'], conn)
+        reservation['event_name'] = event['name']
+        reservation['event_start_at'] = event['start_at']
+        reservation['event_end_at'] = event['end_at']
+        reservation['event_price'] = event['price']
+        reservation['venue_name'] = utility.get_venue_by_id(app, event['venue_id'], conn)['name']
+        reservation['created_at'] = utility.convert_to_iso8601(reservation['created_at'])
+        reservation['updated_at'] = utility.convert_to_iso8601(reservation['updated_at'])
+        response.append(reservation)
+    return response
+
+
+def measure(fn, reservations, conn):
+    counting = CountingConnection(conn)
+    expected = fn(app, copy.deepcopy(reservations), counting)
+    queries = counting.queries
+    latency = timeit(lambda: fn(app, copy.deepcopy(reservations), conn), repeat=5)
+    return expected, queries, latency
+
+
+def main():
+    conn = connect()
+
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT event_id FROM reservations GROUP BY event_id ORDER BY COUNT(*) DESC LIMIT 1')
+        event_id = cursor.fetchone()['event_id']
+
+    print('{:>5} {:>6} {:>14} {:>14} {:>14} {:>14}'.format(
+        'limit', 'rows', 'before [query]', 'after [query]', 'before [ms]', 'after [ms]'))
+
+    for limit in (10, 100, 1000):
+        # 1イベントの予約だけでは足りない場合はユーザ・イベントが混ざったページにする
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT * FROM reservations ORDER BY event_id = %s DESC, id LIMIT %s', (event_id, limit))
+            reservations = cursor.fetchall()
+
+        before, before_queries, before_latency = measure(generate_reservations_response_per_row, reservations, conn)
+        after, after_queries, after_latency = measure(utility.generate_reservations_response, reservations, conn)
+        # 以前の実装はdatetimeを文字列に変換済みなので，書き出したJSONで比較する
+        assert fastjson.dumps(before) == fastjson.dumps(after)
+
+        print('{:>5} {:>6} {:>14} {:>14} {:>14.2f} {:>14.2f}'.format(
+            limit, len(reservations), before_queries, after_queries, before_latency * 1000, after_latency * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""ベンチマークスクリプトの共通処理
+
+アプリと同じ環境変数(MYSQL_HOST等)でutils.databaseを使って接続する．
+"""
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utils.database import connect  # noqa: E402,F401
+
+
+class DummyApp:
+    """utilityの関数に渡すappの代わり(loggerだけ使われる)"""
+    logger = logging.getLogger('bench')
+
+
+class CountingConnection:
+    """発行したクエリ数を数えるコネクションのラッパ"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.queries = 0
+
+    def cursor(self):
+        return _CountingCursor(self, self.conn.cursor())
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+class _CountingCursor:
+    def __init__(self, owner, cursor):
+        self.owner = owner
+        self.cursor = cursor
+
+    def execute(self, query, args=None):
+        self.owner.queries += 1
+        return self.cursor.execute(query, args)
+
+    def executemany(self, query, args):
+        self.owner.queries += 1
+        return self.cursor.executemany(query, args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cursor.close()
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+def timeit(fn, repeat=20):
+    """fnをrepeat回実行し，1回あたりの平均秒数を返す"""
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - begin) / repeat
@@ -0,0 +1,63 @@
+"""gunicornの設定
+
+    $ gunicorn -c gunicorn.conf.py app:app
+
+アプリケーションをマスタープロセスで読み込み(preload)，スキーマの確認と参照データの読み込みを
+fork前に1回だけ行う．その後gc.freeze()して，読み込んだオブジェクトのページが
+子プロセスのGCで書き換えられ(コピーされ)ないようにする．
+各ワーカーはpost_forkでコネクションプールなどを準備し，終わるまでGET /api/readyは503を返す．
+"""
+import gc
+import os
+
+
+def cpu_count():
+    # コンテナ等でCPUが制限されている場合は使えるコアの数
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+cores = cpu_count()
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+# CPUを使う処理(JSONのエンコード等)はプロセスで，DBの待ちはスレッドで並列化する
+workers = int(os.getenv('GUNICORN_WORKERS', '0')) or cores * 2 + 1
+# 1コアあたりの同時リクエスト数をCONCURRENCY_PER_CORE(2コアで以前の -w 5 --thread 5 と同じ)にする
+threads = int(os.getenv('GUNICORN_THREADS', '0')) or \
+    -(-cores * int(os.getenv('CONCURRENCY_PER_CORE', '12')) // workers)
+worker_class = 'gthread'
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+
+# 各スレッドがプールのコネクションを待たないようにする(app.pyを読み込む前に設定する)
+os.environ.setdefault('DB_POOL_MAX_SIZE', str(threads))
+
+# fork前に作られるオブジェクトのページに穴を開けないよう，マスタープロセスではGCを止めておく
+gc.disable()
+
+
+def when_ready(server):
+    # preloadした場合，ここはアプリケーションの読み込み後，最初のforkの前に呼ばれる
+    if preload_app:
+        import app
+        try:
+            app.load_shared_state()
+        except Exception as e:
+            # 各ワーカーがwarm_up()で改めてスキーマを確認する
+            server.log.exception(e)
+
+    gc.freeze()
+    server.log.info('workers=%d threads=%d preload=%s frozen=%d', workers, threads, preload_app,
+                    gc.get_freeze_count())
+
+
+def post_fork(server, worker):
+    gc.enable()
+
+    import app
+    try:
+        app.warm_up()
+    except Exception as e:
+        # 最初のリクエストの前にもう一度試す
+        worker.log.exception(e)
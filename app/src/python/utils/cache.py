@@ -0,0 +1,84 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """有効期限付きのLRUキャッシュ(スレッドセーフ)
+
+    エントリごとに有効期限(UNIX時間)を指定でき，期限を過ぎたエントリはヒットしない．
+    maxsizeを超えた場合は最も長く参照されていないエントリから追い出す．
+    maxbytesを指定した場合はlen(value)の合計がmaxbytesを超えないようにも追い出す．
+    """
+
+    def __init__(self, maxsize=1024, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key -> (value, expires_at)
+        self._bytes = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.time():
+                self._remove(key)
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, expires_at=None):
+        with self._lock:
+            self._remove(key)
+            if self.maxbytes is not None:
+                if len(value) > self.maxbytes:
+                    return
+                self._bytes += len(value)
+
+            self._data[key] = (value, expires_at)
+            while len(self._data) > self.maxsize or \
+                    (self.maxbytes is not None and self._bytes > self.maxbytes):
+                self._remove(next(iter(self._data)))
+
+    def pop(self, key):
+        with self._lock:
+            return self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return None
+        if self.maxbytes is not None:
+            self._bytes -= len(entry[0])
+        return entry[0]
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        stats = {'size': len(self._data),
+                 'maxsize': self.maxsize,
+                 'hits': self.hits,
+                 'misses': self.misses,
+                 'hit_ratio': self.hits / total if total else 0.0}
+        if self.maxbytes is not None:
+            stats['bytes'] = self._bytes
+            stats['maxbytes'] = self.maxbytes
+        return stats
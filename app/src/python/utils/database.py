@@ -0,0 +1,19 @@
+"""DBへの接続パラメータ
+
+アプリ，python -m utils.* のコマンド，ベンチマークで共通の環境変数(MYSQL_HOST等)を使う．
+"""
+import os
+
+import pymysql.cursors
+
+dbparams = {
+    'host': os.getenv('MYSQL_HOST', '127.0.0.1'),
+    'user': os.getenv('MYSQL_USER'),
+    'password': os.getenv('MYSQL_PASSWORD'),
+    'database': os.getenv('MYSQL_DATABASE'),
+    'cursorclass': pymysql.cursors.DictCursor
+}
+
+
+def connect():
+    return pymysql.connect(**dbparams)
@@ -0,0 +1,165 @@
+import os
+import threading
+import time
+from collections import deque
+
+
+class PoolTimeoutError(Exception):
+    """コネクションプールが枯渇したまま待ち時間を超えたことを知らせるクラス"""
+    pass
+
+
+class ConnectionPool:
+    """ワーカープロセス内で共有するスレッドセーフなコネクションプール
+
+    - 取り出し時，ping_interval秒以上使われていなかったコネクションは生存確認する
+    - max_lifetime秒を超えたコネクションは作り直す
+    - 返却時にrollbackし，トランザクションの状態を次のリクエストに持ち越さない
+    """
+
+    def __init__(self, connect, minsize=1, maxsize=5, timeout=10, max_lifetime=3600, ping_interval=5):
+        self.connect = connect
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.ping_interval = ping_interval
+
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = deque()  # (conn, last_used_at)
+        self._created_at = {}  # id(conn) -> created_at
+        self._size = 0
+
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.max_in_use = 0
+
+    def _check_fork(self):
+        # fork前のコネクションは親プロセスのものなので使わない(閉じもしない)
+        if self._pid != os.getpid():
+            self._reset()
+
+    def fill(self):
+        """minsize個のコネクションを事前に張る"""
+        with self._cond:
+            self._check_fork()
+            while self._size < self.minsize:
+                conn = self.connect()
+                self._created_at[id(conn)] = time.time()
+                self._idle.append((conn, time.time()))
+                self._size += 1
+
+    def acquire(self):
+        begin = time.perf_counter()
+        waited = False
+
+        with self._cond:
+            self._check_fork()
+            while True:
+                if self._idle:
+                    conn, last_used_at = self._idle.pop()
+                    break
+
+                if self._size < self.maxsize:
+                    # 接続はロックの外で張る
+                    self._size += 1
+                    conn = None
+                    break
+
+                waited = True
+                remaining = self.timeout - (time.perf_counter() - begin)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeoutError
+                self._cond.wait(remaining)
+
+            self.checkouts += 1
+            self.max_in_use = max(self.max_in_use, self._size - len(self._idle))
+            if waited:
+                elapsed = time.perf_counter() - begin
+                self.waits += 1
+                self.wait_time_total += elapsed
+                self.wait_time_max = max(self.wait_time_max, elapsed)
+
+        try:
+            if conn is None:
+                return self._open()
+            return self._validate(conn, last_used_at)
+
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn):
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+
+        try:
+            conn.rollback()
+            reusable = conn.open
+        except Exception:
+            reusable = False
+
+        with self._cond:
+            if reusable:
+                self._idle.append((conn, time.time()))
+            else:
+                self._discard(conn)
+            self._cond.notify()
+
+    def _open(self):
+        conn = self.connect()
+        self._created_at[id(conn)] = time.time()
+        return conn
+
+    def _validate(self, conn, last_used_at):
+        now = time.time()
+
+        if now - self._created_at.get(id(conn), now) > self.max_lifetime:
+            self._close(conn)
+            return self._open()
+
+        if now - last_used_at > self.ping_interval:
+            try:
+                conn.ping(reconnect=False)
+            except Exception:
+                self._close(conn)
+                return self._open()
+
+        return conn
+
+    def _close(self, conn):
+        self._created_at.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _discard(self, conn):
+        self._close(conn)
+        self._size -= 1
+
+    def stats(self):
+        in_use = self._size - len(self._idle)
+        return {'size': self._size,
+                'idle': len(self._idle),
+                'in_use': in_use,
+                'max_in_use': self.max_in_use,
+                'maxsize': self.maxsize,
+                'saturation': in_use / self.maxsize,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'wait_time_total': self.wait_time_total,
+                'wait_time_max': self.wait_time_max,
+                'wait_time_avg': self.wait_time_total / self.waits if self.waits else 0.0}
@@ -0,0 +1,45 @@
+"""APIレスポンスのJSONエンコーダ
+
+jsonify(JSON_AS_ASCII=False, JSON_SORT_KEYS=True)と同じバイト列を出力する．datetimeは
+utility.convert_to_iso8601と同じ形式(isoformat()+'Z')で書き出すので，事前に変換しておく必要はない．
+orjsonがインストールされていれば使い，扱えない値が含まれる場合は標準のjsonにフォールバックする．
+
+orjsonを使う場合，datetimeはタイムゾーンを持たない(PyMySQLが返す)ものだけが同じ形式になる．
+また浮動小数点数の表記が標準のjsonと異なる場合がある(APIのレスポンスには含まれない)．
+"""
+import json
+from datetime import datetime
+
+from flask import current_app
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(o):
+    if isinstance(o, datetime):
+        return o.isoformat() + 'Z'
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(o).__name__))
+
+
+_encoder = json.JSONEncoder(ensure_ascii=False, sort_keys=True, separators=(',', ':'), default=default)
+
+
+def dumps(obj):
+    """jsonifyのレスポンスの本文と同じバイト列(末尾の改行を含む)を返す"""
+    if orjson is not None:
+        try:
+            # naiveなdatetimeはOPT_NAIVE_UTCとOPT_UTC_Zで isoformat()+'Z' と同じ形式になる
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z |
+                                orjson.OPT_APPEND_NEWLINE)
+        except TypeError:
+            # 64ビットを超える整数や文字列以外のキーなど
+            pass
+
+    return (_encoder.encode(obj) + '\n').encode('utf-8')
+
+
+def response(obj):
+    return current_app.response_class(dumps(obj), mimetype=current_app.config['JSONIFY_MIMETYPE'])
@@ -0,0 +1,112 @@
+import os
+
+from utils.revocation import FileLock
+
+# ChangeLogで全てのキーが変更されたことを表す
+ALL = '*'
+
+
+class SharedGeneration:
+    """ファイルをワーカー間で共有する世代番号として使う
+
+    bump()はpathのファイルに1バイト追記し，current()はファイルの(inode, サイズ)を返す．
+    (更新時刻は粒度が粗く，続けてbump()した場合に変化しないことがあるので使わない)
+    ファイルがmax_file_sizeを超えたら作り直す．inodeが変わるので読み手からは世代が変わったように見える．
+    """
+
+    def __init__(self, path, max_file_size=1024 * 1024):
+        self.path = path
+        self.max_file_size = max_file_size
+
+    def current(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_size
+
+    def bump(self):
+        with open(self.path, 'ab') as f:
+            f.write(b'.')
+            size = f.tell()
+
+        if size > self.max_file_size:
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'wb'):
+                pass
+            os.replace(tmp_path, self.path)
+
+
+class ChangeLog:
+    """追記専用のファイルで変更されたキーを1行ずつワーカー間に知らせる
+
+    読み手は前回読んだ位置から後ろだけを読む．ファイルがmax_sizeを超えたらALLだけを書いた別のファイルで置き換え，
+    読み手はinodeが変わった(作り直された)ことに気付いた場合もALL(全て変更された)として扱う．
+    (同じinodeのまま切り詰めると，しばらく読まなかった読み手は元の位置より伸びたファイルの先頭を読み飛ばす)
+    """
+
+    def __init__(self, path, max_size=1024 * 1024):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.max_size = max_size
+
+        self.offset = None
+        self._inode = None
+
+    def seek_end(self):
+        """これまでの変更を読み飛ばす"""
+        try:
+            st = os.stat(self.path)
+            self.offset = st.st_size
+            self._inode = st.st_ino
+        except FileNotFoundError:
+            self.offset = 0
+            self._inode = None
+
+    def append(self, key):
+        with FileLock(self.lock_path, True):
+            try:
+                size = os.path.getsize(self.path)
+            except OSError:
+                size = 0
+
+            if size <= self.max_size:
+                with open(self.path, 'a') as f:
+                    f.write('{}\n'.format(key))
+                return
+
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                f.write('{}\n'.format(ALL))
+            os.replace(tmp_path, self.path)
+
+    def read(self):
+        """前回から追記されたキーの一覧を返す(スレッドセーフではない)"""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return []
+
+        if st.st_ino == self._inode and st.st_size == self.offset:
+            return []
+
+        keys = []
+        if st.st_ino != self._inode or self.offset is None or st.st_size < self.offset:
+            keys.append(ALL)
+            self.offset = 0
+
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+
+        # 書きかけの行は次回読む
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            line = line.decode('utf-8').strip()
+            if line != '':
+                keys.append(line)
+
+        self.offset += end
+        self._inode = st.st_ino
+
+        return keys
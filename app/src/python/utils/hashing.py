@@ -0,0 +1,66 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# 短い入力に対するhashlibはGILを解放しないため，ストレッチングは別プロセスで計算する
+enabled = os.getenv('PASSWORD_HASH_EXECUTOR', 'inline') == 'process'
+max_workers = int(os.getenv('PASSWORD_HASH_WORKERS', '0')) or os.cpu_count() or 1
+timeout = float(os.getenv('PASSWORD_HASH_TIMEOUT', '5'))
+
+_lock = threading.Lock()
+_executor = None
+_pid = None
+
+
+def start():
+    """ハッシュ計算用のプロセスプールを起動する(ワーカープロセスごとに1つ)"""
+    global _executor, _pid
+
+    if not enabled:
+        return None
+
+    with _lock:
+        # fork前に作られたプールは子プロセスから使えないので作り直す
+        if _executor is None or _pid != os.getpid():
+            _executor = ProcessPoolExecutor(max_workers=max_workers)
+            _pid = os.getpid()
+
+            # ProcessPoolExecutorは最初のsubmit()まで子プロセスを作らないので，ここで全て起動しておく
+            # (スレッドが動き出した後のリクエストの途中でforkしないようにする)
+            futures = [_executor.submit(_noop) for _ in range(max_workers)]
+            for future in futures:
+                future.result(timeout=timeout)
+
+    return _executor
+
+
+def _noop():
+    return None
+
+
+def shutdown():
+    global _executor, _pid
+
+    with _lock:
+        if _executor is not None and _pid == os.getpid():
+            _executor.shutdown(wait=False)
+        _executor = None
+        _pid = None
+
+
+def run(fn, *args):
+    """有効ならプロセスプールで，そうでなければこのスレッドでfnを実行する
+
+    プールで実行した場合，timeout秒以内に終わらなければconcurrent.futures.TimeoutErrorを送出する．
+    """
+    if not enabled:
+        return fn(*args)
+
+    executor = _executor if _pid == os.getpid() else start()
+    try:
+        return executor.submit(fn, *args).result(timeout=timeout)
+    except BrokenProcessPool:
+        # 子プロセスが落ちた場合は次回作り直し，今回はこのスレッドで計算する
+        shutdown()
+        return fn(*args)
@@ -0,0 +1,259 @@
+"""イベント画像の保存先
+
+画像はSHA-256をファイル名としてそのまま(base64にせず)ファイルに保存し，eventsにはハッシュだけを持たせる．
+同じ内容の画像は1つのファイルを共有する．複数ノードで動かす場合に備えて本体はevent_imagesテーブルにも保存し，
+ローカルにファイルが無ければテーブルから取り出して置く．
+
+events.imageに残っているbase64の画像は次のコマンドで移行できる．
+
+    $ cd app/src/python && python -m utils.imagestore migrate
+"""
+import base64
+import hashlib
+import os
+import struct
+import sys
+import tempfile
+
+from utils.cache import LRUCache
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# シグネチャ(8) + IHDRチャンク(長さ4 + 種類4 + データ13 + CRC4)
+PNG_HEADER_SIZE = 33
+
+# カラータイプ -> 使用できるビット深度
+PNG_BIT_DEPTHS = {0: (1, 2, 4, 8, 16), 2: (8, 16), 3: (1, 2, 4, 8), 4: (8, 16), 6: (8, 16)}
+
+CHUNK_SIZE = 64 * 1024
+
+TABLE = "CREATE TABLE IF NOT EXISTS event_images (" \
+        " hash CHAR(64) CHARACTER SET ascii NOT NULL," \
+        " data MEDIUMBLOB NOT NULL," \
+        " PRIMARY KEY (hash)" \
+        ")"
+
+
+class InvalidImageError(Exception):
+    """PNGとして不正な画像や大きすぎる画像であることを知らせるクラス"""
+    pass
+
+
+def check_png_header(head):
+    """先頭のバイト列がPNGのシグネチャとIHDRチャンクとして正しいか確認する"""
+    if len(head) < PNG_HEADER_SIZE or head[:8] != PNG_SIGNATURE:
+        raise InvalidImageError('not a PNG file')
+
+    length, chunk_type, width, height, bit_depth, color_type, compression, filter_method, interlace = \
+        struct.unpack('>I4sIIBBBBB', head[8:29])
+    if length != 13 or chunk_type != b'IHDR':
+        raise InvalidImageError('IHDR chunk not found')
+    if width == 0 or height == 0 or width > 0x7fffffff or height > 0x7fffffff:
+        raise InvalidImageError('invalid image size')
+    if bit_depth not in PNG_BIT_DEPTHS.get(color_type, ()):
+        raise InvalidImageError('invalid bit depth or color type')
+    if compression != 0 or filter_method != 0 or interlace not in (0, 1):
+        raise InvalidImageError('invalid IHDR')
+
+
+class CappedStream:
+    """streamからmax_sizeを超えて読もうとしたらInvalidImageErrorを送出する(Content-Lengthの無い本文用)"""
+
+    def __init__(self, stream, max_size):
+        self.stream = stream
+        self.max_size = max_size
+        self.size = 0
+
+    def read(self, size=-1):
+        return self._count(self.stream.read(size))
+
+    def readline(self, size=-1):
+        return self._count(self.stream.readline(size))
+
+    def _count(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise InvalidImageError('request body too large')
+        return data
+
+
+class ImageStore:
+    """ハッシュをファイル名として画像を保存する．読み出した画像はcache_bytesまでメモリに保持する"""
+
+    def __init__(self, root, cache_bytes=0):
+        self.root = root
+        self.cache = LRUCache(maxsize=sys.maxsize, maxbytes=cache_bytes)
+        self._max_db_size = None
+
+    def path(self, image_hash):
+        return os.path.join(self.root, image_hash[:2], image_hash)
+
+    def put(self, data, cursor):
+        """画像を保存してハッシュを返す"""
+        image_hash = hashlib.sha256(data).hexdigest()
+        self.write(image_hash, data)
+
+        query = 'INSERT IGNORE INTO event_images (hash, data) VALUES (%s, %s)'
+        cursor.execute(query, (image_hash, data))
+
+        return image_hash
+
+    def put_stream(self, stream, cursor, max_size):
+        """streamからPNG画像をCHUNK_SIZEずつ読みながら保存してハッシュを返す
+
+        先頭でPNGのヘッダを確認し，max_sizeを超えた時点で読むのをやめてInvalidImageErrorを送出する．
+        event_imagesへは1回のINSERTで保存するので，max_sizeはmax_db_size()以下に抑える．
+        """
+        max_size = min(max_size, self.max_db_size(cursor))
+
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            sha256 = hashlib.sha256()
+            size = 0
+            head = b''
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+
+                    size += len(chunk)
+                    if size > max_size:
+                        raise InvalidImageError('image too large')
+
+                    if len(head) < PNG_HEADER_SIZE:
+                        head += chunk[:PNG_HEADER_SIZE - len(head)]
+                        if len(head) == PNG_HEADER_SIZE:
+                            check_png_header(head)
+
+                    sha256.update(chunk)
+                    f.write(chunk)
+
+            check_png_header(head)
+
+            image_hash = sha256.hexdigest()
+            path = self.path(image_hash)
+            if os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        # 同じ画像が既に登録されていればファイルを読み直さない
+        query = 'SELECT 1 FROM event_images WHERE hash = %s'
+        cursor.execute(query, (image_hash,))
+        if cursor.fetchone() is None:
+            with open(path, 'rb') as f:
+                query = 'INSERT IGNORE INTO event_images (hash, data) VALUES (%s, %s)'
+                cursor.execute(query, (image_hash, f.read()))
+
+        return image_hash
+
+    def max_db_size(self, cursor):
+        """event_imagesに1回のINSERTで保存できる画像の大きさ(エスケープで最大2倍になる分を見込む)"""
+        if self._max_db_size is None:
+            cursor.execute('SELECT @@max_allowed_packet AS max_allowed_packet')
+            self._max_db_size = cursor.fetchone()['max_allowed_packet'] // 2 - 1024
+        return self._max_db_size
+
+    def write(self, image_hash, data):
+        path = self.path(image_hash)
+        if os.path.exists(path):
+            return path
+
+        # 同じワーカーの複数のスレッドが同じ画像を書くことがあるので，一時ファイルの名前は重ならないようにする
+        # (同じハッシュなら内容も同じなので，後から置き換えても問題ない)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        return path
+
+    def load(self, image_hash, conn):
+        """(画像のバイト列, None)を返す．キャッシュに載らない大きさの場合は(None, ファイルのパス)を返す"""
+        data = self.cache.get(image_hash)
+        if data is not None:
+            return data, None
+
+        path = self.get_path(image_hash, conn)
+        if path is None:
+            return None, None
+
+        if os.path.getsize(path) > self.cache.maxbytes:
+            return None, path
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.cache.set(image_hash, data)
+
+        return data, None
+
+    def get_path(self, image_hash, conn):
+        """画像ファイルのパスを返す．このノードに無ければevent_imagesから取り出して置く"""
+        path = self.path(image_hash)
+        if os.path.exists(path):
+            return path
+
+        with conn.cursor() as cursor:
+            query = 'SELECT data FROM event_images WHERE hash = %s'
+            cursor.execute(query, (image_hash,))
+
+            result = cursor.fetchone()
+
+        if result is None:
+            return None
+
+        return self.write(image_hash, result['data'])
+
+
+def migrate(store, conn, batch_size=100):
+    """events.imageのbase64の画像をImageStoreに移し，移した件数を返す"""
+    migrated = 0
+    while True:
+        with conn.cursor() as cursor:
+            query = 'SELECT id, image FROM events WHERE image IS NOT NULL LIMIT %s'
+            cursor.execute(query, (batch_size,))
+
+            events = cursor.fetchall()
+            if len(events) == 0:
+                return migrated
+
+            for event in events:
+                image_hash = store.put(base64.b64decode(event['image']), cursor)
+
+                query = 'UPDATE events SET image_hash = %s, image = NULL WHERE id = %s'
+                cursor.execute(query, (image_hash, event['id']))
+
+        conn.commit()
+        migrated += len(events)
+
+
+def main(argv):
+    from utils import database
+
+    if len(argv) != 2 or argv[1] != 'migrate':
+        print('usage: python -m utils.imagestore migrate', file=sys.stderr)
+        return 2
+
+    conn = database.connect()
+
+    store = ImageStore(os.getenv('IMAGE_STORE_PATH', 'images'))
+    print('migrated {} images'.format(migrate(store, conn)))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
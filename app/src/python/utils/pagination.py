@@ -0,0 +1,53 @@
+"""カーソルによるページング
+
+一覧系のAPIでcursorクエリパラメータを指定した場合は，offsetの代わりにキーの順で並べ，
+前のページの最後の行のキーより後ろをインデックスで探して返す．次のページのカーソルは
+X-Next-Cursorヘッダで返す(最後のページでは付けない)．最初のページはcursorを空文字列にする．
+"""
+import base64
+import json
+
+HEADER = 'X-Next-Cursor'
+
+
+def get_cursor(request, types):
+    """(カーソルを指定したか, 前のページの最後の行のキー)を返す．キーは最初のページではNone
+
+    カーソルが不正な場合はValueErrorを送出する
+    """
+    cursor = request.args.get('cursor', None)
+    if cursor is None:
+        return False, None
+    if cursor == '':
+        return True, None
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError('invalid cursor')
+
+    if not isinstance(values, list) or len(values) != len(types) or \
+            not all(isinstance(v, t) and not isinstance(v, bool) for v, t in zip(values, types)):
+        raise ValueError('invalid cursor')
+
+    return True, values
+
+
+def encode(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def next_cursor(rows, limit, key):
+    """ページが埋まっていれば最後の行のキーから次のカーソルを作る．最後のページならNoneを返す
+
+    行はレスポンスの生成で書き換えられるので，その前に呼ぶこと
+    """
+    if limit > 0 and len(rows) == limit:
+        return encode(key(rows[-1]))
+    return None
+
+
+def set_next_cursor(response, cursor):
+    if cursor is not None:
+        response.headers.set(HEADER, cursor)
+    return response
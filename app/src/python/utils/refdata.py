@@ -0,0 +1,94 @@
+import bisect
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+from flask import json
+
+from utils.generation import SharedGeneration
+
+# genres_by_id・venues_by_idの値は書き換えられないようにMappingProxyTypeで包む
+Snapshot = namedtuple('Snapshot', ['genres_json', 'genres_by_id', 'venues_by_id', 'venue_ids', 'venue_jsons'])
+
+
+class ReferenceData:
+    """eventgenresとvenuesをワーカー内に保持する(これらのテーブルは/api/initializeでしか変わらない)
+
+    /api/initializeでinvalidate()するとpathのファイルで共有する世代が進み，
+    各ワーカーは次に参照したときに読み直す．レスポンスはjsonifyと同じ形式でシリアライズしておく．
+    """
+
+    def __init__(self, path, convert_to_iso8601):
+        self.shared_generation = SharedGeneration(path)
+        self.convert_to_iso8601 = convert_to_iso8601
+
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._generation = None
+
+        self.reloads = 0
+
+    def get(self, conn):
+        generation = self.shared_generation.current()
+        snapshot = self._snapshot
+        if snapshot is not None and generation == self._generation:
+            return snapshot
+
+        with self._lock:
+            if self._snapshot is None or generation != self._generation:
+                self._snapshot = self._load(conn)
+                self._generation = generation
+            return self._snapshot
+
+    def invalidate(self, conn):
+        """全ワーカーに読み直させ，このワーカーではすぐに読み直す"""
+        self.shared_generation.bump()
+        with self._lock:
+            self._snapshot = None
+        self.get(conn)
+
+    def _load(self, conn):
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT * FROM eventgenres')
+            genres = cursor.fetchall()
+
+            cursor.execute('SELECT * FROM venues ORDER BY id')
+            venues = cursor.fetchall()
+
+        venue_jsons = []
+        for venue in venues:
+            record = dict(venue)
+            record['created_at'] = self.convert_to_iso8601(record['created_at'])
+            record['updated_at'] = self.convert_to_iso8601(record['updated_at'])
+            venue_jsons.append(dumps(record))
+
+        self.reloads += 1
+        return Snapshot(genres_json=dumps_list([dumps(genre) for genre in genres]),
+                        genres_by_id=MappingProxyType({g['id']: MappingProxyType(g) for g in genres}),
+                        venues_by_id=MappingProxyType({v['id']: MappingProxyType(v) for v in venues}),
+                        venue_ids=tuple(v['id'] for v in venues),
+                        venue_jsons=tuple(venue_jsons))
+
+    def venue_page(self, conn, offset, limit, after_id=None):
+        """(シリアライズ済みのJSON, ページ内の会場IDの一覧)を返す．offsetがNoneの場合はafter_idより後ろを返す"""
+        snapshot = self.get(conn)
+        if offset is None:
+            offset = bisect.bisect_right(snapshot.venue_ids, after_id or 0)
+
+        return (dumps_list(snapshot.venue_jsons[offset:offset + limit]),
+                snapshot.venue_ids[offset:offset + limit])
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {'reloads': self.reloads,
+                'genres': 0 if snapshot is None else len(snapshot.genres_by_id),
+                'venues': 0 if snapshot is None else len(snapshot.venue_ids)}
+
+
+def dumps(obj):
+    # jsonifyと同じ形式 (アプリケーションコンテキストの中で呼ぶこと．デバッグ時の整形は行わない)
+    return json.dumps(obj, indent=None, separators=(',', ':')).encode('utf-8')
+
+
+def dumps_list(items):
+    return b'[' + b','.join(items) + b']\n'
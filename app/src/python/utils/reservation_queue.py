@@ -0,0 +1,175 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from utils import seat_counts
+
+RESERVED = 'reserved'
+ALREADY_RESERVED = 'already_reserved'
+SOLD_OUT = 'sold_out'
+
+
+class ReservationBatcher:
+    """予約をまとめて1トランザクションで処理するキュー(グループコミット)
+
+    リクエストスレッドはsubmit()で予約を積んで結果を待つ．専用スレッドが最初の予約から
+    window秒の間に届いた予約(最大max_batch件)をまとめ，対象イベントの予約数の行をロックしたうえで
+    到着順に空席を判定し，受け付けた予約を1つのINSERTで挿入して1回だけコミットする．
+    """
+
+    def __init__(self, connect, window=0.003, max_batch=64, timeout=10, on_sold_out=None):
+        self.connect = connect
+        self.on_sold_out = on_sold_out
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._conn = None
+
+        self.batches = 0
+        self.requests = 0
+
+    def submit(self, user_id, event_id, num_of_resv, capacity):
+        """(RESERVED, 予約ID) / (ALREADY_RESERVED, None) / (SOLD_OUT, None) のいずれかを返す"""
+        future = Future()
+        self._start().put((user_id, event_id, num_of_resv, capacity, future))
+        return future.result(timeout=self.timeout)
+
+    def _start(self):
+        # forkした子プロセスでは専用スレッドを起動し直す
+        if self._pid == os.getpid():
+            return self._queue
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._conn = None
+                threading.Thread(target=self._loop, args=(self._queue,), daemon=True).start()
+                self._pid = os.getpid()
+
+        return self._queue
+
+    def _loop(self, requests):
+        while True:
+            batch = [requests.get()]
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                results = self._process(batch)
+            except Exception as e:
+                self._close()
+                for item in batch:
+                    item[4].set_exception(e)
+                continue
+
+            self.batches += 1
+            self.requests += len(batch)
+            for item, result in zip(batch, results):
+                item[4].set_result(result)
+
+    def _process(self, batch):
+        if self._conn is None:
+            self._conn = self.connect()
+
+        conn = self._conn
+        event_ids = sorted(set(item[1] for item in batch))
+        user_ids = sorted(set(item[0] for item in batch))
+        events = ', '.join(['%s'] * len(event_ids))
+        users = ', '.join(['%s'] * len(user_ids))
+
+        try:
+            with conn.cursor() as cursor:
+                conn.begin()
+
+                # イベントごとの予約数の行をevent_id順にロックする(デッドロックを避ける)
+                query = 'SELECT event_id, current_resv FROM event_seat_counts' \
+                        ' WHERE event_id IN ({}) ORDER BY event_id FOR UPDATE'.format(events)
+                cursor.execute(query, event_ids)
+                current_resvs = {r['event_id']: r['current_resv'] for r in cursor.fetchall()}
+
+                if len(current_resvs) != len(event_ids):
+                    seat_counts.ensure(cursor, event_ids)
+                    cursor.execute(query, event_ids)
+                    current_resvs = {r['event_id']: r['current_resv'] for r in cursor.fetchall()}
+                initial_resvs = dict(current_resvs)
+
+                query = 'SELECT event_id, user_id FROM reservations' \
+                        ' WHERE event_id IN ({}) AND user_id IN ({})'.format(events, users)
+                cursor.execute(query, event_ids + user_ids)
+                reserved = set((r['event_id'], r['user_id']) for r in cursor.fetchall())
+
+                # 到着順に判定する
+                results = []
+                accepted = []
+                for user_id, event_id, num_of_resv, capacity, _ in batch:
+                    if (event_id, user_id) in reserved:
+                        results.append((ALREADY_RESERVED, None))
+                        continue
+
+                    current_resv = current_resvs.get(event_id, 0)
+                    if current_resv + num_of_resv > capacity:
+                        results.append((SOLD_OUT, None))
+                        continue
+
+                    current_resvs[event_id] = current_resv + num_of_resv
+                    reserved.add((event_id, user_id))
+                    accepted.append((user_id, event_id, num_of_resv))
+                    results.append((RESERVED, (event_id, user_id)))
+
+                if accepted:
+                    query = 'INSERT INTO reservations(user_id, event_id, num_of_resv) VALUES ' + \
+                            ', '.join(['(%s, %s, %s)'] * len(accepted))
+                    cursor.execute(query, [v for row in accepted for v in row])
+
+                    # 採番されたidは(event_id, user_id)のユニーク制約で引き直す
+                    query = 'SELECT id, event_id, user_id FROM reservations' \
+                            ' WHERE event_id IN ({}) AND user_id IN ({})'.format(events, users)
+                    cursor.execute(query, event_ids + user_ids)
+                    ids = {(r['event_id'], r['user_id']): r['id'] for r in cursor.fetchall()}
+
+                    results = [(status, ids[key] if status == RESERVED else None) for status, key in results]
+
+                    for event_id, current_resv in current_resvs.items():
+                        if current_resv != initial_resvs.get(event_id, 0):
+                            seat_counts.add(cursor, event_id, current_resv - initial_resvs.get(event_id, 0))
+
+                conn.commit()
+
+            # 満席になった(または満席で断った)イベントを知らせる
+            if self.on_sold_out is not None:
+                capacities = {item[1]: item[3] for item in batch}
+                for event_id, current_resv in current_resvs.items():
+                    if current_resv >= capacities[event_id]:
+                        self.on_sold_out(event_id)
+
+            return results
+
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def stats(self):
+        return {'batches': self.batches,
+                'requests': self.requests,
+                'avg_batch_size': self.requests / self.batches if self.batches else 0.0}
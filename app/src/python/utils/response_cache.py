@@ -0,0 +1,72 @@
+import threading
+import time
+
+from utils.cache import LRUCache
+from utils.generation import SharedGeneration
+
+
+class ResponseCache:
+    """シリアライズ済みのレスポンスをワーカー内に保持するキャッシュ
+
+    エントリはttl秒で失効する．invalidate()はpathのファイルで共有する世代を進め，
+    各ワーカーはget/setのたびに世代を確認して変わっていれば全エントリを捨てる．
+    生成中に無効化された場合に古い内容を保存しないよう，生成前にbegin()で世代を取得してset()に渡す．
+    """
+
+    def __init__(self, path, ttl=1.0, maxsize=1024):
+        self.ttl = ttl
+        self.shared_generation = SharedGeneration(path)
+
+        self._cache = LRUCache(maxsize)
+        self._lock = threading.Lock()
+        self._generation = None
+
+        self.invalidations = 0
+        self.max_age = 0.0
+        self._total_age = 0.0
+
+    def begin(self):
+        """現在の世代を返す"""
+        self._check()
+        return self._generation
+
+    def get(self, key):
+        self._check()
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+
+        value, created_at = entry
+        age = time.time() - created_at
+        self._total_age += age
+        if age > self.max_age:
+            self.max_age = age
+        return value
+
+    def set(self, key, value, generation):
+        now = time.time()
+        if self.begin() != generation:
+            return
+        self._cache.set(key, (value, now), now + self.ttl)
+
+    def invalidate(self):
+        self._cache.clear()
+        self.invalidations += 1
+        self.shared_generation.bump()
+
+    def _check(self):
+        generation = self.shared_generation.current()
+        if generation != self._generation:
+            with self._lock:
+                if generation != self._generation:
+                    self._cache.clear()
+                    self._generation = generation
+
+    def stats(self):
+        stats = self._cache.stats()
+        stats['ttl'] = self.ttl
+        stats['invalidations'] = self.invalidations
+        # ヒットしたエントリが作られてからの経過秒数
+        stats['max_age'] = self.max_age
+        stats['avg_age'] = self._total_age / self._cache.hits if self._cache.hits else 0.0
+        return stats
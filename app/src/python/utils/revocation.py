@@ -0,0 +1,352 @@
+import fcntl
+import hashlib
+import os
+import threading
+import time
+
+import jwt
+
+
+class RevocationIndex:
+    """失効済みトークンをワーカー内のハッシュ集合として保持するクラス
+
+    リストファイルは読み込み済みのオフセットを覚えておき，追記された分だけを読み込む．
+    ファイルが置き換えられた(inodeが変わった)か切り詰められた場合は先頭から読み直す．
+    """
+
+    def __init__(self, path, compact_interval=60):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.compact_interval = compact_interval
+
+        self._lock = threading.Lock()
+        self._tokens = {}  # token -> exp (デコードできなければNone)
+        self._offset = 0
+        self._inode = None
+        self._mtime = None
+        self._next_prune = 0
+        self._compactor = None
+
+    def is_revoked(self, token):
+        self._refresh()
+        return token in self._tokens
+
+    def revoke(self, token, conn=None):
+        with self._file_lock():
+            with open(self.path, 'a') as f:
+                f.write(token + '\n')
+
+        with self._lock:
+            self._tokens[token] = _get_exp(token)
+
+    def _refresh(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            if self._inode is not None:
+                with self._lock:
+                    self._reset()
+            return
+
+        if st.st_ino == self._inode and st.st_size == self._offset and st.st_mtime == self._mtime:
+            self._prune()
+            return
+
+        with self._lock:
+            if st.st_ino != self._inode or st.st_size < self._offset:
+                self._offset = 0
+                self._load(st, {})
+            else:
+                self._load(st, self._tokens)
+
+        self._prune()
+        self._start_compactor()
+
+    def _reset(self):
+        self._tokens = {}
+        self._offset = 0
+        self._inode = None
+        self._mtime = None
+
+    def _load(self, st, tokens):
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+
+        # 書き込み途中の行は次回に読む
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            token = line.decode('utf-8').strip()
+            if token != '':
+                tokens[token] = _get_exp(token)
+
+        # 読み直した場合は読み込みが終わってから差し替える
+        self._tokens = tokens
+        self._offset += end
+        self._inode = st.st_ino
+        self._mtime = st.st_mtime
+
+    def _prune(self):
+        now = time.time()
+        if now < self._next_prune:
+            return
+
+        with self._lock:
+            self._next_prune = now + self.compact_interval
+            expired = [t for t, exp in self._tokens.items() if exp is not None and exp < now]
+            for token in expired:
+                del self._tokens[token]
+
+    def _start_compactor(self):
+        if self._compactor is not None:
+            return
+
+        with self._lock:
+            if self._compactor is not None:
+                return
+            self._compactor = threading.Thread(target=self._compact_loop, daemon=True)
+            self._compactor.start()
+
+    def _compact_loop(self):
+        while True:
+            time.sleep(self.compact_interval)
+            try:
+                self.compact()
+            except Exception:
+                pass
+
+    def compact(self):
+        """期限切れのトークンをリストファイルから取り除く
+
+        ファイルロックを取れなかった場合は他のワーカーが処理中とみなして何もしない．
+        """
+        with self._file_lock(blocking=False) as locked:
+            if not locked or not os.path.isfile(self.path):
+                return
+
+            now = time.time()
+            with open(self.path, 'r') as f:
+                lines = [line.strip() for line in f]
+
+            alive = []
+            for token in lines:
+                if token == '':
+                    continue
+                exp = _get_exp(token)
+                if exp is None or exp >= now:
+                    alive.append(token)
+
+            if len(alive) == len(lines):
+                return
+
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                for token in alive:
+                    f.write(token + '\n')
+            os.replace(tmp_path, self.path)
+
+    def _file_lock(self, blocking=True):
+        return FileLock(self.lock_path, blocking)
+
+
+class RevocationStore:
+    """失効済みトークンをDBのテーブルで共有するクラス
+
+    各ノード(ワーカー)はローカルにトークン集合を持ち，バックグラウンドのスレッドが
+    poll_interval秒ごとに既知のid(ウォーターマーク)より新しい行だけを取得する．
+    そのため認証時にDBへ問い合わせることはなく，他ノードでのログアウトもpoll_interval程度で反映される．
+
+    AUTO_INCREMENTのidは挿入時に割り当てられるため，小さいidの行が後からコミットされることがある．
+    ウォーターマークまでの間で見つからなかったidは，gap_timeout秒の間は毎回問い合わせ直す．
+
+    トークンはusernameを含むので長さに上限が無い．テーブルにもローカルにもSHA-256だけを持つ．
+    """
+
+    def __init__(self, connect, poll_interval=0.2, prune_interval=60, gap_timeout=10, max_gap=1000):
+        self.connect = connect
+        self.poll_interval = poll_interval
+        self.prune_interval = prune_interval
+        self.gap_timeout = gap_timeout
+        self.max_gap = max_gap
+
+        self._lock = threading.Lock()
+        self._tokens = {}  # token_hash(token) -> exp
+        self._watermark = 0
+        self._gaps = {}  # まだ見つかっていないid -> 諦める時刻
+        self._next_prune = 0
+        self._poller = None
+        self._pid = None
+        self._conn = None
+
+    def start(self):
+        self._start_poller()
+
+    def is_revoked(self, token):
+        self._start_poller()
+        return token_hash(token) in self._tokens
+
+    def revoke(self, token, conn):
+        digest = token_hash(token)
+        exp = _get_exp(token)
+        with conn.cursor() as cursor:
+            query = 'INSERT IGNORE INTO revoked_tokens (token_hash, expires_at) VALUES (%s, %s)'
+            cursor.execute(query, (digest, exp))
+        conn.commit()
+
+        with self._lock:
+            self._tokens[digest] = exp
+
+    def import_file(self, path, conn):
+        """リストファイルに書かれたトークン(seed等)をテーブルに取り込む"""
+        if not os.path.isfile(path):
+            return
+
+        with open(path, 'r') as f:
+            tokens = [line.strip() for line in f]
+
+        rows = [(token_hash(token), _get_exp(token)) for token in tokens if token != '']
+        with conn.cursor() as cursor:
+            query = 'INSERT IGNORE INTO revoked_tokens (token_hash, expires_at) VALUES (%s, %s)'
+            for i in range(0, len(rows), 1000):
+                cursor.executemany(query, rows[i:i + 1000])
+        conn.commit()
+
+    def poll(self):
+        if self._conn is None:
+            self._conn = self.connect()
+            # REPEATABLE READのスナップショットに閉じ込められないようにする
+            self._conn.autocommit(True)
+
+        now = time.time()
+        gap_ids = [i for i, deadline in self._gaps.items() if deadline >= now]
+
+        with self._conn.cursor() as cursor:
+            query = 'SELECT id, token_hash, expires_at FROM revoked_tokens WHERE id > %s ORDER BY id'
+            cursor.execute(query, (self._watermark,))
+            rows = cursor.fetchall()
+
+            filled = []
+            if gap_ids:
+                query = 'SELECT id, token_hash, expires_at FROM revoked_tokens WHERE id IN ({})'.format(
+                    ','.join(['%s'] * len(gap_ids)))
+                cursor.execute(query, gap_ids)
+                filled = cursor.fetchall()
+
+            if len(rows) == 0:
+                # /api/initialize でテーブルが作り直された場合はidが巻き戻る
+                cursor.execute('SELECT MAX(id) AS max_id FROM revoked_tokens')
+                max_id = cursor.fetchone()['max_id'] or 0
+                if max_id < self._watermark:
+                    with self._lock:
+                        self._watermark = 0
+                        self._gaps = {}
+                    return
+
+        with self._lock:
+            gaps = {i: self._gaps[i] for i in gap_ids}
+            for row in filled:
+                self._tokens[row['token_hash']] = row['expires_at']
+                gaps.pop(row['id'], None)
+
+            expected = self._watermark + 1
+            for row in rows:
+                self._tokens[row['token_hash']] = row['expires_at']
+                # 飛ばされたidはまだコミットされていない可能性がある
+                # (import_fileのINSERT IGNOREで重複した行もidを消費するので，大きく飛んだ場合は追わない)
+                if row['id'] - expected <= self.max_gap:
+                    for i in range(expected, row['id']):
+                        gaps[i] = now + self.gap_timeout
+                expected = row['id'] + 1
+
+            if rows:
+                self._watermark = rows[-1]['id']
+            self._gaps = gaps
+
+    def prune(self):
+        now = time.time()
+        with self._lock:
+            expired = [t for t, exp in self._tokens.items() if exp is not None and exp < now]
+            for token in expired:
+                del self._tokens[token]
+
+        with self._conn.cursor() as cursor:
+            query = 'DELETE FROM revoked_tokens WHERE expires_at < %s'
+            cursor.execute(query, (int(now),))
+
+    def _start_poller(self):
+        if self._poller is not None and self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._poller is not None and self._pid == os.getpid():
+                return
+            # fork前に起動したスレッドは子プロセスには無く，接続は親プロセスのものなので使わない
+            self._conn = None
+            self._poller = threading.Thread(target=self._poll_loop, daemon=True)
+            self._pid = os.getpid()
+
+        # 起動直後に失効済みトークンを受け付けないよう，初回だけは同期的に読み込む
+        try:
+            self.poll()
+        except Exception:
+            self._close()
+        self._poller.start()
+
+    def _poll_loop(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.poll()
+                if time.time() >= self._next_prune:
+                    self._next_prune = time.time() + self.prune_interval
+                    self.prune()
+            except Exception:
+                # 接続が切れた場合は次回つなぎ直す
+                self._close()
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+
+class FileLock:
+    """ワーカー間で追記とコンパクションを排他するためのflock"""
+
+    def __init__(self, path, blocking):
+        self.path = path
+        self.blocking = blocking
+        self._fd = None
+
+    def __enter__(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        flags = fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(self._fd, flags)
+        except BlockingIOError:
+            os.close(self._fd)
+            self._fd = None
+            return False
+        return True
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        return False
+
+
+def token_hash(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def _get_exp(token):
+    try:
+        claims = jwt.decode(token, verify=False)
+        return int(claims['exp'])
+    except Exception:
+        return None
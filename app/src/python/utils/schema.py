@@ -0,0 +1,261 @@
+"""アプリケーションが必要とするテーブルやインデックスのマイグレーション
+
+MIGRATIONSをバージョン順に適用し，適用したバージョンをschema_migrationsに記録する．
+各操作は既に適用済みでも失敗しないように書くこと(/api/initializeでDBが作り直された後にも再度適用する)．
+
+    $ cd app/src/python && python -m utils.schema status    # 適用済みのバージョンを表示する
+    $ cd app/src/python && python -m utils.schema migrate   # 適用し，前後のEXPLAINを表示する
+"""
+import sys
+from collections import namedtuple
+
+from utils import imagestore, seat_counts
+
+# 存在しない場合だけ追加するカラム
+Column = namedtuple('Column', ['table', 'column', 'definition'])
+# 同じ名前か，同じカラムに対するインデックスが無い場合だけ追加するインデックス
+Index = namedtuple('Index', ['table', 'name', 'columns', 'unique'])
+
+# (バージョン, 説明, 操作の一覧) 操作はDDL(文字列)かColumnかIndex
+MIGRATIONS = [
+    (1, 'token revocations, seat counts and image store', [
+        # 失効済みトークン (複数ノード・ワーカー間で共有する．バージョン4でrevoked_tokensに移す)
+        "CREATE TABLE IF NOT EXISTS token_revocations ("
+        " id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,"
+        " token VARCHAR(512) CHARACTER SET ascii COLLATE ascii_bin NOT NULL,"
+        " expires_at BIGINT NULL,"
+        " created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,"
+        " PRIMARY KEY (id),"
+        " UNIQUE KEY uniq_token (token)"
+        ")",
+        # イベントごとの予約数
+        seat_counts.TABLE,
+        # イベント画像の本体(ハッシュで重複を除く)
+        imagestore.TABLE,
+        # イベント画像のSHA-256 (画像の本体はimagestoreに置く)
+        Column('events', 'image_hash', 'CHAR(64) CHARACTER SET ascii NULL'),
+        # 同じユーザによる同じイベントへの重複予約を防ぐ
+        Index('reservations', 'uniq_event_user', ('event_id', 'user_id'), True),
+    ]),
+    (2, 'indexes for cursor pagination', [
+        # InnoDBのセカンダリインデックスは末尾に主キーを含むので(…, id)の順に読める
+        Index('reservations', 'idx_event_id', ('event_id',), False),
+        Index('reservations', 'idx_user_id', ('user_id',), False),
+        Index('events', 'idx_start_at', ('start_at',), False),
+        Index('events', 'idx_user_start_at', ('user_id', 'start_at'), False),
+    ]),
+    (3, 'indexes for hot lookups', [
+        # ログイン・サインアップ
+        Index('users', 'idx_username', ('username',), False),
+        # イベントのタイムスロット一覧・付け替え
+        Index('timeslots', 'idx_event_id', ('event_id',), False),
+        # 会場の空きタイムスロットの検索 (event_id IS NULL の範囲をstart_at順に読む)
+        Index('timeslots', 'idx_venue_event_start_at', ('venue_id', 'event_id', 'start_at'), False),
+    ]),
+    (4, 'store SHA-256 of revoked tokens', [
+        # トークンはusernameを含み長さに上限が無いので，ハッシュだけを持つ
+        "CREATE TABLE IF NOT EXISTS revoked_tokens ("
+        " id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,"
+        " token_hash CHAR(64) CHARACTER SET ascii COLLATE ascii_bin NOT NULL,"
+        " expires_at BIGINT NULL,"
+        " created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,"
+        " PRIMARY KEY (id),"
+        " UNIQUE KEY uniq_token_hash (token_hash)"
+        ")",
+        # バージョン1のtoken_revocationsから移す(再確認で作り直された空のテーブルも消す)
+        "INSERT IGNORE INTO revoked_tokens (token_hash, expires_at)"
+        " SELECT SHA2(token, 256), expires_at FROM token_revocations ORDER BY id",
+        "DROP TABLE token_revocations",
+    ]),
+]
+
+# (名前, クエリ, 引数) migrateの前後でEXPLAINを表示するクエリ
+HOT_QUERIES = [
+    ('user by username',
+     'SELECT * FROM users WHERE username = %s', ('user',)),
+    ('reservation by event and user',
+     'SELECT id FROM reservations WHERE event_id = %s AND user_id = %s', (1, 1)),
+    ('reservations by event (cursor)',
+     'SELECT * FROM reservations WHERE event_id = %s AND id > %s ORDER BY id LIMIT %s', (1, 0, 10)),
+    ('reservations by user (cursor)',
+     'SELECT * FROM reservations WHERE user_id = %s AND id > %s ORDER BY id LIMIT %s', (1, 0, 5)),
+    ('timeslots by event',
+     'SELECT id, event_id FROM timeslots WHERE event_id IN (%s, %s) ORDER BY id', (1, 2)),
+    ('free timeslots of venue',
+     'SELECT * FROM timeslots WHERE venue_id = %s AND event_id IS NULL AND %s <= start_at AND start_at <= %s',
+     (1, '2020-01-01', '2030-12-31')),
+    ('upcoming events (cursor)',
+     'SELECT id FROM events WHERE %s <= start_at ORDER BY start_at, id LIMIT %s', ('2020-01-01', 12)),
+    ('upcoming events of artist',
+     'SELECT id FROM events WHERE %s <= start_at AND user_id = %s LIMIT %s OFFSET %s', ('2020-01-01', 1, 12, 0)),
+]
+
+MIGRATIONS_TABLE = "CREATE TABLE IF NOT EXISTS schema_migrations (" \
+                   " version INT NOT NULL," \
+                   " description VARCHAR(255) NOT NULL," \
+                   " applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP," \
+                   " PRIMARY KEY (version)" \
+                   ")"
+
+# 複数のワーカーが同時に起動した場合に1つずつ適用する
+LOCK_NAME = 'schema_migrations'
+LOCK_TIMEOUT = 60
+
+
+def apply(app, conn, recheck=False):
+    """未適用のマイグレーションを適用し，予約数のカウンタを作成する(何度実行してもよい)"""
+    try:
+        migrate(conn, app.logger, recheck)
+
+        with conn.cursor() as cursor:
+            seat_counts.ensure(cursor)
+        conn.commit()
+
+    except Exception as e:
+        conn.rollback()
+        app.logger.exception(e)
+        raise
+
+
+def migrate(conn, logger=None, recheck=False):
+    """未適用のマイグレーションを適用し，適用したバージョンの一覧を返す
+
+    recheckを指定した場合は，適用済みのバージョンの操作も(テーブルが作り直されている場合に備えて)確認する
+    """
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT GET_LOCK(%s, %s) AS locked', (LOCK_NAME, LOCK_TIMEOUT))
+        if not cursor.fetchone()['locked']:
+            raise RuntimeError('could not acquire lock {}'.format(LOCK_NAME))
+
+        try:
+            cursor.execute(MIGRATIONS_TABLE)
+            applied = get_applied_versions(cursor)
+
+            versions = []
+            for version, description, operations in MIGRATIONS:
+                if version in applied:
+                    if recheck:
+                        for operation in operations:
+                            apply_operation(cursor, operation)
+                    continue
+
+                for operation in operations:
+                    apply_operation(cursor, operation)
+
+                query = 'INSERT INTO schema_migrations (version, description) VALUES (%s, %s)'
+                cursor.execute(query, (version, description))
+                conn.commit()
+
+                if logger is not None:
+                    logger.info('applied schema migration %d: %s', version, description)
+                versions.append(version)
+
+            return versions
+
+        finally:
+            cursor.execute('SELECT RELEASE_LOCK(%s)', (LOCK_NAME,))
+
+
+def get_applied_versions(cursor):
+    cursor.execute('SELECT version FROM schema_migrations')
+    return set(r['version'] for r in cursor.fetchall())
+
+
+def apply_operation(cursor, operation):
+    if isinstance(operation, Column):
+        def exists():
+            return has_column(cursor, operation.table, operation.column)
+        statement = 'ALTER TABLE {} ADD COLUMN {} {}'.format(operation.table, operation.column, operation.definition)
+    elif isinstance(operation, Index):
+        def exists():
+            return has_index(cursor, operation.table, operation.name, operation.columns, operation.unique)
+        statement = 'ALTER TABLE {} ADD {} {} ({})'.format(operation.table,
+                                                          'UNIQUE KEY' if operation.unique else 'KEY',
+                                                          operation.name, ', '.join(operation.columns))
+    else:
+        cursor.execute(operation)
+        return
+
+    if exists():
+        return
+
+    try:
+        cursor.execute(statement)
+    except Exception:
+        # 他のノードが同時に作成した場合は問題ない
+        if not exists():
+            raise
+
+
+def has_column(cursor, table, column):
+    query = 'SELECT 1 FROM information_schema.columns' \
+            ' WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s LIMIT 1'
+    cursor.execute(query, (table, column))
+    return cursor.fetchone() is not None
+
+
+def has_index(cursor, table, index, columns, unique=False):
+    """同じ名前のインデックスか，同じカラムに対する(uniqueの場合はユニークな)インデックスがあるか"""
+    # MySQL 8ではinformation_schemaの列名が大文字で返るので別名を付ける
+    query = 'SELECT index_name AS index_name, column_name AS column_name, non_unique AS non_unique' \
+            ' FROM information_schema.statistics' \
+            ' WHERE table_schema = DATABASE() AND table_name = %s ORDER BY index_name, seq_in_index'
+    cursor.execute(query, (table,))
+
+    indexes = {}
+    for r in cursor.fetchall():
+        cols, _ = indexes.setdefault(r['index_name'], ([], not int(r['non_unique'])))
+        cols.append(r['column_name'].lower())
+
+    if index in indexes:
+        return True
+    return any(tuple(cols) == tuple(columns) and (is_unique or not unique) for cols, is_unique in indexes.values())
+
+
+def explain(conn):
+    """HOT_QUERIESのEXPLAINの結果を(名前, 行の一覧)のリストで返す"""
+    results = []
+    with conn.cursor() as cursor:
+        for name, query, args in HOT_QUERIES:
+            cursor.execute('EXPLAIN ' + query, args)
+            results.append((name, cursor.fetchall()))
+    return results
+
+
+def print_explain(title, results):
+    print('== {}'.format(title))
+    for name, rows in results:
+        print('-- {}'.format(name))
+        for r in rows:
+            print('   table={} type={} key={} rows={} extra={}'.format(
+                r.get('table'), r.get('type'), r.get('key'), r.get('rows'), r.get('Extra')))
+
+
+def main(argv):
+    from utils import database
+
+    if len(argv) != 2 or argv[1] not in ('status', 'migrate'):
+        print('usage: python -m utils.schema status|migrate', file=sys.stderr)
+        return 2
+
+    conn = database.connect()
+
+    if argv[1] == 'migrate':
+        before = explain(conn)
+        versions = migrate(conn)
+        print_explain('before', before)
+        print_explain('after', explain(conn))
+        print('applied: {}'.format(versions))
+        return 0
+
+    with conn.cursor() as cursor:
+        cursor.execute(MIGRATIONS_TABLE)
+        applied = get_applied_versions(cursor)
+    for version, description, _ in MIGRATIONS:
+        print('{} {:>3} {}'.format('*' if version in applied else ' ', version, description))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
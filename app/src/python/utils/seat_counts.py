@@ -0,0 +1,109 @@
+"""イベントごとの予約数(event_seat_counts)の管理
+
+event_seat_counts.current_resv は reservations.num_of_resv のイベントごとの合計を非正規化したもので，
+予約の登録・削除と同じトランザクションで更新する．reservationsを直接書き換えた場合は再計算すること．
+
+    $ cd app/src/python && python -m utils.seat_counts verify   # 食い違いを表示する
+    $ cd app/src/python && python -m utils.seat_counts repair   # reservationsから再計算する
+"""
+import sys
+
+TABLE = "CREATE TABLE IF NOT EXISTS event_seat_counts (" \
+        " event_id INT NOT NULL," \
+        " current_resv INT NOT NULL DEFAULT 0," \
+        " PRIMARY KEY (event_id)" \
+        ")"
+
+
+def ensure(cursor, event_ids=None):
+    """カウンタ行が無いイベント(event_idsを省略した場合は全イベント)について，reservationsから集計して作成する
+
+    集計にはこのトランザクションで挿入した(未コミットの)予約も含まれる．作成した行の数を返す．
+    """
+    query = 'INSERT IGNORE INTO event_seat_counts (event_id, current_resv)' \
+            ' SELECT e.id, COALESCE(SUM(r.num_of_resv), 0) FROM events e' \
+            ' LEFT JOIN reservations r ON r.event_id = e.id' \
+            ' LEFT JOIN event_seat_counts c ON c.event_id = e.id' \
+            ' WHERE c.event_id IS NULL'
+    args = []
+    if event_ids is not None:
+        query += ' AND e.id IN ({})'.format(', '.join(['%s'] * len(event_ids)))
+        args = list(event_ids)
+    query += ' GROUP BY e.id'
+    return cursor.execute(query, args)
+
+
+def get(cursor, event_id):
+    """予約数を返す．カウンタ行が無い場合はNoneを返す"""
+    cursor.execute('SELECT current_resv FROM event_seat_counts WHERE event_id = %s', (event_id,))
+    row = cursor.fetchone()
+    return None if row is None else row['current_resv']
+
+
+def add(cursor, event_id, num_of_resv, capacity=None):
+    """予約数を増減する．capacityを指定した場合は超えないときだけ更新する
+
+    更新後の予約数を返し，更新できなかった場合はNoneを返す．
+    (LAST_INSERT_ID(expr)の値はOKパケットで返るので，読み直すクエリは要らない)
+    """
+    if capacity is None:
+        query = 'UPDATE event_seat_counts SET current_resv = LAST_INSERT_ID(current_resv + %s) WHERE event_id = %s'
+        cursor.execute(query, (num_of_resv, event_id))
+    else:
+        query = 'UPDATE event_seat_counts SET current_resv = LAST_INSERT_ID(current_resv + %s)' \
+                ' WHERE event_id = %s AND current_resv + %s <= %s'
+        cursor.execute(query, (num_of_resv, event_id, num_of_resv, capacity))
+
+    return cursor.lastrowid if cursor.rowcount == 1 else None
+
+
+def repair(conn):
+    """全イベントの予約数をreservationsから再計算する"""
+    with conn.cursor() as cursor:
+        query = 'INSERT INTO event_seat_counts (event_id, current_resv)' \
+                ' SELECT e.id, COALESCE(SUM(r.num_of_resv), 0) FROM events e' \
+                ' LEFT JOIN reservations r ON r.event_id = e.id GROUP BY e.id' \
+                ' ON DUPLICATE KEY UPDATE current_resv = VALUES(current_resv)'
+        cursor.execute(query)
+
+        query = 'DELETE c FROM event_seat_counts c LEFT JOIN events e ON e.id = c.event_id WHERE e.id IS NULL'
+        cursor.execute(query)
+
+    conn.commit()
+
+
+def verify(conn):
+    """reservationsの合計と食い違っている(event_id, current_resv, 実際の合計)の一覧を返す"""
+    with conn.cursor() as cursor:
+        query = 'SELECT e.id AS event_id, c.current_resv, COALESCE(SUM(r.num_of_resv), 0) AS actual' \
+                ' FROM events e' \
+                ' LEFT JOIN event_seat_counts c ON c.event_id = e.id' \
+                ' LEFT JOIN reservations r ON r.event_id = e.id' \
+                ' GROUP BY e.id, c.current_resv' \
+                ' HAVING c.current_resv IS NULL OR c.current_resv <> actual'
+        cursor.execute(query)
+
+        return [(r['event_id'], r['current_resv'], int(r['actual'])) for r in cursor.fetchall()]
+
+
+def main(argv):
+    from utils import database
+
+    if len(argv) != 2 or argv[1] not in ('verify', 'repair'):
+        print('usage: python -m utils.seat_counts verify|repair', file=sys.stderr)
+        return 2
+
+    conn = database.connect()
+
+    if argv[1] == 'repair':
+        repair(conn)
+
+    mismatches = verify(conn)
+    for event_id, current_resv, actual in mismatches:
+        print('event_id={} current_resv={} actual={}'.format(event_id, current_resv, actual))
+
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,71 @@
+import threading
+import time
+
+from utils.generation import ALL, ChangeLog
+
+# リリースログでこの行は全イベントの解除を表す
+RELEASE_ALL = ALL
+
+
+class SoldOutSet:
+    """満席になったイベントをワーカー内で覚えておき，予約をDBに問い合わせずに断るためのクラス
+
+    満席の記録はttl秒で失効し，その後は再びDBで確認される．
+    予約の取り消しで空席ができた場合はリリースログ(ファイル)にevent_idを追記し，
+    各ワーカーは満席と判定する直前に追記分だけを読んで該当イベントを外す．
+    """
+
+    def __init__(self, path, ttl=1.0, max_log_size=1024 * 1024):
+        self.path = path
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._events = {}  # event_id -> expires_at
+        self._log = ChangeLog(path, max_log_size)
+
+        self.rejected = 0
+
+    def is_sold_out(self, event_id):
+        expires_at = self._events.get(event_id)
+        if expires_at is None:
+            return False
+
+        if expires_at < time.time():
+            self._events.pop(event_id, None)
+            return False
+
+        self._read_releases()
+        if event_id not in self._events:
+            return False
+
+        self.rejected += 1
+        return True
+
+    def mark(self, event_id):
+        with self._lock:
+            if self._log.offset is None:
+                # 以前のリリースは関係ないので末尾から読み始める
+                self._log.seek_end()
+            self._events[event_id] = time.time() + self.ttl
+
+    def release(self, event_id=RELEASE_ALL):
+        """空席ができたことを全ワーカーに知らせる．event_idを省略した場合は全イベントを解除する"""
+        with self._lock:
+            if event_id == RELEASE_ALL:
+                self._events.clear()
+            else:
+                self._events.pop(event_id, None)
+
+        # 大きくなったら作り直される(読み手は全イベントを解除して読み直す)
+        self._log.append(event_id)
+
+    def _read_releases(self):
+        with self._lock:
+            for key in self._log.read():
+                if key == RELEASE_ALL:
+                    self._events.clear()
+                else:
+                    self._events.pop(int(key), None)
+
+    def stats(self):
+        return {'size': len(self._events), 'rejected': self.rejected}
@@ -0,0 +1,120 @@
+import bisect
+import calendar
+import threading
+import time
+from collections import namedtuple
+
+from utils.generation import ALL, ChangeLog
+
+# starts[i]はrecords[i]の開始時刻(UNIX時間)．recordsはAPIのレスポンスの形にしたタイムスロット
+VenueSlots = namedtuple('VenueSlots', ['starts', 'records', 'loaded_at'])
+
+
+def to_epoch(d):
+    """naiveなdatetime(UTC)をUNIX時間にする．マイクロ秒は切り捨てる"""
+    return calendar.timegm(d.timetuple())
+
+
+class TimeslotIndex:
+    """会場ごとの空きタイムスロットを開始時刻順に並べてワーカー内に保持する
+
+    タイムスロットを確保・解放したら会場IDをinvalidate()でchangelog(ファイル)に追記し，
+    各ワーカーは参照する前に追記分を読んで該当する会場を捨てる(次の参照でDBから読み直す)．
+    他のノードでの変更に備えて，reconcile_interval秒より古い会場も読み直す．
+    読み込み中の変更は他のスレッドが先にchangelogから読むこともあるので，会場ごとの版数で検出する．
+    """
+
+    def __init__(self, path, convert_to_iso8601, reconcile_interval=30.0):
+        self.convert_to_iso8601 = convert_to_iso8601
+        self.reconcile_interval = reconcile_interval
+
+        self._lock = threading.Lock()
+        self._venues = {}  # venue_id -> VenueSlots
+        self._versions = {}  # venue_id -> changelogで変更を読んだ回数
+        self._all_version = 0
+        self._log = ChangeLog(path)
+        self._log.seek_end()
+
+        self.hits = 0
+        self.loads = 0
+
+    def find(self, venue_id, from_, to, conn):
+        """venue_idの空きタイムスロットのうち，開始時刻がfrom_以上to以下のものを返す"""
+        slots = self._get(venue_id, conn)
+
+        # from_は切り上げ，toは切り捨てて秒単位で比較する
+        start = to_epoch(from_) + (1 if from_.microsecond else 0)
+        lo = bisect.bisect_left(slots.starts, start)
+        hi = bisect.bisect_right(slots.starts, to_epoch(to))
+        return slots.records[lo:hi]
+
+    def preload(self, venue_ids, conn):
+        """venue_idsの空きタイムスロットを読み込んでおく"""
+        for venue_id in venue_ids:
+            self._get(venue_id, conn)
+
+    def invalidate(self, venue_ids=None):
+        """venue_ids(省略した場合は全ての会場)のタイムスロットが変わったことを全ワーカーに知らせる"""
+        keys = [ALL] if venue_ids is None else set(venue_ids)
+        for key in keys:
+            self._log.append(key)
+        self._read_changes()
+
+    def _get(self, venue_id, conn):
+        self._read_changes()
+
+        slots = self._venues.get(venue_id)
+        if slots is not None and time.time() - slots.loaded_at < self.reconcile_interval:
+            self.hits += 1
+            return slots
+
+        with self._lock:
+            version = self._version(venue_id)
+        slots = self._load(venue_id, conn)
+
+        # 読んでいる間に(どのスレッドが読んだかに関わらず)変更された場合は保持しない
+        self._read_changes()
+        with self._lock:
+            if self._version(venue_id) == version:
+                self._venues[venue_id] = slots
+        return slots
+
+    def _version(self, venue_id):
+        return self._all_version, self._versions.get(venue_id, 0)
+
+    def _load(self, venue_id, conn):
+        loaded_at = time.time()
+        with conn.cursor() as cursor:
+            query = 'SELECT id, start_at, end_at, created_at, updated_at FROM timeslots' \
+                    ' WHERE venue_id = %s AND event_id IS NULL ORDER BY start_at, id'
+            cursor.execute(query, (venue_id,))
+
+            results = cursor.fetchall()
+
+        starts = []
+        records = []
+        for result in results:
+            starts.append(to_epoch(result['start_at']))
+            records.append({'id': result['id'],
+                            'start_at': self.convert_to_iso8601(result['start_at']),
+                            'end_at': self.convert_to_iso8601(result['end_at']),
+                            'created_at': self.convert_to_iso8601(result['created_at']),
+                            'updated_at': self.convert_to_iso8601(result['updated_at'])})
+
+        self.loads += 1
+        return VenueSlots(starts=starts, records=records, loaded_at=loaded_at)
+
+    def _read_changes(self):
+        with self._lock:
+            keys = self._log.read()
+            for key in keys:
+                if key == ALL:
+                    self._venues.clear()
+                    self._all_version += 1
+                else:
+                    venue_id = int(key)
+                    self._venues.pop(venue_id, None)
+                    self._versions[venue_id] = self._versions.get(venue_id, 0) + 1
+
+    def stats(self):
+        return {'venues': len(self._venues), 'hits': self.hits, 'loads': self.loads}
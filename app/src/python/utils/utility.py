@@ -1,19 +1,62 @@
 import calendar
 import hashlib
+import hmac
 import os
 import secrets
+import threading
+import time
+from collections import namedtuple
 from datetime import datetime as dt
 from datetime import timedelta
-from functools import wraps
+from functools import lru_cache, wraps
 
 import flask
 from flask import abort, jsonify
 
 import iso8601
 import jwt
+import pymysql
+from utils import hashing, reservation_queue, seat_counts
+from utils.cache import LRUCache
+from utils.generation import SharedGeneration
+from utils.refdata import ReferenceData
+from utils.revocation import RevocationIndex, RevocationStore
+from utils.soldout import SoldOutSet
+from utils.timeslot_index import TimeslotIndex
 
 secret = os.getenv('JWT_SECRET_KEY', 'da4855bf92b81fafaa170ba2aa9757c4')
 revocation_list_path = os.getenv('REVOCATION_LIST_PATH', 'TokenRevocationList.dat')
+revocation_backend = os.getenv('REVOCATION_BACKEND', 'db')
+revocation_poll_interval = float(os.getenv('REVOCATION_POLL_INTERVAL', '0.2'))
+revocation_store = RevocationIndex(revocation_list_path)
+
+# 検証済みトークン -> Identity
+verified_token_cache = LRUCache(int(os.getenv('JWT_CACHE_SIZE', '10000')))
+# user_idを含まない古いトークン向け username -> user_id
+user_id_cache = LRUCache(int(os.getenv('USER_ID_CACHE_SIZE', '20000')))
+# HMAC(username, password) -> ログインに成功したユーザ
+credential_cache = LRUCache(int(os.getenv('LOGIN_CACHE_SIZE', '20000')))
+credential_cache_ttl = int(os.getenv('LOGIN_CACHE_TTL', '30'))
+credential_cache_secret = secrets.token_bytes(32)
+# user_id_cacheとcredential_cacheの世代 (/api/initializeでusersが入れ替わったら全ワーカーで捨てる)
+user_cache_generation = SharedGeneration(os.getenv('USER_CACHE_GENERATION_PATH', 'UserCaches.dat'))
+user_cache_lock = threading.Lock()
+user_cache_seen = None
+# 満席のイベント
+sold_out_events = SoldOutSet(os.getenv('SOLD_OUT_RELEASE_PATH', 'SoldOutReleases.dat'),
+                             float(os.getenv('SOLD_OUT_TTL', '1')))
+# eventgenresとvenues
+reference_data = ReferenceData(os.getenv('REFERENCE_DATA_GENERATION_PATH', 'ReferenceData.dat'),
+                               lambda d: convert_to_iso8601(d))
+# 会場ごとの空きタイムスロット
+timeslot_index = TimeslotIndex(os.getenv('TIMESLOT_CHANGELOG_PATH', 'TimeslotChanges.dat'),
+                               lambda d: convert_to_iso8601(d),
+                               float(os.getenv('TIMESLOT_RECONCILE_INTERVAL', '30')))
+# jwt_requiredがDBを参照する場合に使うコネクションの取得関数
+connection_getter = None
+
+# ログインユーザ
+Identity = namedtuple('Identity', ['user_id', 'username', 'role'])
 
 
 class IDNotFoundError(Exception):
@@ -32,8 +75,8 @@ class DuplicatedError(Exception):
 
 
 def create_access_token(userobject):
-    payload = {"iat": get_unixtime(), "exp": get_unixtime(3600), "username": userobject["username"],
-               "role": userobject["role"]}
+    payload = {"iat": get_unixtime(), "exp": get_unixtime(3600), "user_id": userobject["id"],
+               "username": userobject["username"], "role": userobject["role"]}
 
     token = jwt.encode(payload, secret, algorithm='HS256').decode('utf-8')
     return token
@@ -56,22 +99,49 @@ def jwt_required(fn):
         if jwt_token is None or jwt_token == "":
             return jsonify({"message": "Invalid credentials"}), 401
 
-        try:
-            token = jwt.decode(jwt_token, secret, algorithms=['HS256'])
-        except jwt.exceptions.ExpiredSignatureError:
-            return jsonify({"message": "Invalid credentials"}), 401
-        except jwt.InvalidSignatureError:
-            return jsonify({"message": "Invalid credentials"}), 401
+        identity = verified_token_cache.get(jwt_token)
+        if identity is None:
+            try:
+                claims = jwt.decode(jwt_token, secret, algorithms=['HS256'])
+            except jwt.exceptions.ExpiredSignatureError:
+                return jsonify({"message": "Invalid credentials"}), 401
+            except jwt.InvalidSignatureError:
+                return jsonify({"message": "Invalid credentials"}), 401
+
+            if is_revoked(request):
+                return jsonify({"message": "Invalid credentials"}), 401
+
+            identity = get_identity(claims)
+
+            # expを過ぎたエントリはキャッシュからも取り出されない
+            verified_token_cache.set(jwt_token, identity, claims.get('exp'))
 
-        if is_revoked(request):
+        elif is_revoked(request):
+            verified_token_cache.pop(jwt_token)
             return jsonify({"message": "Invalid credentials"}), 401
 
-        else:
-            return fn(token, *args, **kwargs)
+        return fn(identity, *args, **kwargs)
 
     return wrapper
 
 
+def get_identity(claims):
+    user_id = claims.get('user_id')
+
+    if user_id is None:
+        # user_idを含まない古いトークンはusernameから引く
+        generation = check_user_caches()
+        user_id = user_id_cache.get(claims['username'])
+        if user_id is None:
+            user = get_user_by_username(flask.current_app, claims['username'], connection_getter())
+            if user is not None:
+                user_id = user['id']
+                if user_cache_generation.current() == generation:
+                    user_id_cache.set(claims['username'], user_id)
+
+    return Identity(user_id, claims['username'], claims['role'])
+
+
 def get_salt():
     return secrets.token_hex(64)
 
@@ -83,13 +153,63 @@ def get_passwordhash(salt, password):
     return string
 
 
-def is_passwordcorrect(app, username, password, conn):
+def compute_passwordhash(app, salt, password):
+    try:
+        return hashing.run(get_passwordhash, salt, password)
+
+    except Exception as e:
+        app.logger.exception(e)
+        abort(500)
+
+
+def get_credential_key(username, password):
+    # 平文のパスワードはキャッシュに残さない
+    message = username.encode('UTF-8') + b'\0' + password.encode('UTF-8')
+    return hmac.new(credential_cache_secret, message, hashlib.sha256).digest()
+
+
+def authenticate(app, username, password, conn):
+    """認証に成功したらユーザ(id, username, role)を，失敗したらNoneを返す"""
+    key = get_credential_key(username, password)
+    generation = check_user_caches()
+    user = credential_cache.get(key)
+    if user is not None:
+        return user
+
     result = get_user_by_username(app, username, conn)
 
     if result is None:
-        return False
+        return None
+
+    if compute_passwordhash(app, result['salt'], password) != result['password_hash']:
+        return None
+
+    user = {'id': result['id'], 'username': result['username'], 'role': result['role']}
+    # 問い合わせている間に/api/initializeされた場合は保存しない
+    if user_cache_generation.current() == generation:
+        credential_cache.set(key, user, time.time() + credential_cache_ttl)
+
+    return user
+
 
-    return get_passwordhash(result['salt'], password) == result['password_hash']
+def check_user_caches():
+    """他のワーカーでclear_user_caches()されていればこのワーカーのキャッシュも捨て，現在の世代を返す"""
+    global user_cache_seen
+
+    generation = user_cache_generation.current()
+    if generation != user_cache_seen:
+        with user_cache_lock:
+            if generation != user_cache_seen:
+                user_id_cache.clear()
+                credential_cache.clear()
+                user_cache_seen = generation
+    return generation
+
+
+def clear_user_caches():
+    """全ワーカーのuser_id_cacheとcredential_cacheを捨てる"""
+    user_cache_generation.bump()
+    check_user_caches()
 
 
 def get_last_date(dt):
@@ -97,19 +217,49 @@ def get_last_date(dt):
                       hour=23, minute=59, second=59, microsecond=0)
 
 
+def init_revocation_store(connect):
+    global revocation_store
+    if revocation_backend == 'db':
+        revocation_store = RevocationStore(connect, revocation_poll_interval)
+
+
+def import_revocation_list(app, conn):
+    # seedとして配布されるリストファイルをDBに取り込む
+    if not isinstance(revocation_store, RevocationStore):
+        return
+
+    try:
+        revocation_store.import_file(revocation_list_path, conn)
+
+    except Exception as e:
+        app.logger.exception(e)
+        abort(500)
+
+
+def start_revocation_store():
+    # 最初の認証を待たずに失効リストを読み込み，ポーリングを始める
+    if isinstance(revocation_store, RevocationStore):
+        revocation_store.start()
+
+
 def is_revoked(request):
-    if not os.path.isfile(revocation_list_path):
-        return False
+    token = request.headers.get("Authorization")
+    return revocation_store.is_revoked(token.split()[1])
 
-    with open(revocation_list_path, 'r') as f:
-        token = request.headers.get("Authorization")
-        line = f.readline().rstrip('\n')
-        while line:
-            if token.split()[1] == line:
-                return True
-            line = f.readline().rstrip('\n')
 
-        return False
+def revoke_token(jwt_token, conn):
+    revocation_store.revoke(jwt_token, conn)
+    verified_token_cache.pop(jwt_token)
+
+
+def get_cache_stats():
+    return {'reference_data': reference_data.stats(),
+            'verified_token': verified_token_cache.stats(),
+            'user_id': user_id_cache.stats(),
+            'credential': credential_cache.stats(),
+            'sold_out': sold_out_events.stats(),
+            'timeslot_index': timeslot_index.stats(),
+            'parse_datetime': parse_datetime.cache_info()._asdict()}
 
 
 def is_valid_request_id(d):
@@ -143,71 +293,190 @@ def convert_to_iso8601(d):
 
 
 def convert_to_datetime(time):
+    """ISO 8601の文字列をUTCのnaiveなdatetimeに変換する．変換できなければNoneを返す"""
     try:
-        res = iso8601.parse_date(time)
+        return parse_datetime(time)
     except Exception:
         return None
 
-    # 例: +09:00(JST) を 0:00(UTC) に変換
-    if '+' in time:
-        return (res - res.utcoffset()).replace(tzinfo=None)
-    # 例: -09:00 を 0:00(UTC) に変換
-    elif '-' in time:
-        return (res + res.utcoffset()).replace(tzinfo=None)
-    else:
-        return res.utcoffset().replace(tzinfo=None)
+
+@lru_cache(maxsize=4096)
+def parse_datetime(time):
+    # APIで使われる YYYY-MM-DD[THH:MM[:SS[.ffffff]]][Z|±HH:MM] はfromisoformatで解釈し，
+    # それ以外の表記だけiso8601で解釈する
+    s = time
+    if s.endswith('Z'):
+        s = s[:-1] + '+00:00'
+
+    res = None
+    if len(s) >= 10 and s[4] == '-' and s[7] == '-' and (len(s) == 10 or s[10] in 'T '):
+        try:
+            res = dt.fromisoformat(s)
+        except ValueError:
+            pass
+    if res is None:
+        res = iso8601.parse_date(time)
+
+    # タイムゾーンの無い時刻はUTCとみなす
+    if res.tzinfo is None:
+        return res
+
+    # 例: 09:00+09:00(JST) や 15:00-06:00 を 0:00+00:00(UTC) に変換
+    return (res - res.utcoffset()).replace(tzinfo=None)
 
 
 def generate_reservations_response(app, reservations, conn):
+    if len(reservations) == 0:
+        return []
+
+    # 同じユーザ・イベントはまとめて1回だけ取得する
+    usernames = get_usernames_by_ids(app, [reservation['user_id'] for reservation in reservations], conn)
+    events = get_reservation_events_by_ids(app, [reservation['event_id'] for reservation in reservations], conn)
+
+    # datetimeはfastjsonで書き出すときに変換する
     response = []
     for reservation in reservations:
-        reservation['username'] = get_user(app, reservation['user_id'], conn)['username']
-        event = get_event_by_id(app, reservation['event_id'], conn)
-        reservation['event_name'] = event['name']
-        reservation['event_start_at'] = event['start_at']
-        reservation['event_end_at'] = event['end_at']
-        reservation['event_price'] = event['price']
-        reservation['venue_name'] = get_venue_by_id(app,
-                                                    event['venue_id'],
-                                                    conn)['name']
-        reservation['created_at'] = convert_to_iso8601(reservation['created_at'])
-        reservation['updated_at'] = convert_to_iso8601(reservation['updated_at'])
-
-        response.append(reservation)
+        event = events[reservation['event_id']]
+        response.append(dict(reservation,
+                             username=usernames[reservation['user_id']],
+                             event_name=event['name'],
+                             event_start_at=event['start_at'],
+                             event_end_at=event['end_at'],
+                             event_price=event['price'],
+                             venue_name=event['venue_name']))
 
     return response
 
 
 def generate_events_response(app, events, conn):
+    if len(events) == 0:
+        return []
+
+    # ページ内のイベントに必要なデータはまとめて取得する(件数によらずクエリ数は一定)
+    event_ids = [event['id'] for event in events]
+    usernames = get_usernames_by_ids(app, [event['user_id'] for event in events], conn)
+    venues = get_venues_by_ids(app, [event['venue_id'] for event in events], conn)
+    current_resvs = get_current_resvs_by_eventids(app, event_ids, conn)
+    timeslot_ids = get_timeslots_records_ids_by_eventids(app, event_ids, conn)
+
+    # datetimeはfastjsonで書き出すときに変換する
     response = []
     for event in events:
-        event['created_at'] = convert_to_iso8601(event['created_at'])
-        event['updated_at'] = convert_to_iso8601(event['updated_at'])
-        event['start_at'] = convert_to_iso8601(event['start_at'])
-        event['end_at'] = convert_to_iso8601(event['end_at'])
-        event['artist_id'] = event.pop('user_id')
-        event['event_name'] = event.pop('name')
-        event['event_genre_id'] = event.pop('eventgenre_id')
+        venue = venues[event['venue_id']]
+        response.append({'id': event['id'],
+                         'venue_id': event['venue_id'],
+                         'price': event['price'],
+                         'start_at': event['start_at'],
+                         'end_at': event['end_at'],
+                         'created_at': event['created_at'],
+                         'updated_at': event['updated_at'],
+                         'artist_id': event['user_id'],
+                         'artist_name': usernames[event['user_id']],
+                         'event_name': event['name'],
+                         'event_genre_id': event['eventgenre_id'],
+                         'venue_name': venue['name'],
+                         'capacity': venue['capacity'],
+                         'current_resv': current_resvs.get(event['id'], 0),
+                         'timeslot_ids': timeslot_ids.get(event['id'], [])})
+
+    return response
 
-        # get artist name
-        event['artist_name'] = get_user(app, event['artist_id'], conn)['username']
 
-        # get venue_name
-        venue = get_venue_by_id(app, event['venue_id'], conn)
-        event['venue_name'] = venue['name']
+def get_placeholders(values):
+    return ', '.join(['%s'] * len(values))
 
-        # get capaciry
-        event['capacity'] = venue['capacity']
 
-        # get current_resv
-        event['current_resv'] = get_current_resv(app, event['id'], conn)
+def get_usernames_by_ids(app, user_ids, conn):
+    user_ids = list(set(user_ids))
+    try:
+        with conn.cursor() as cursor:
+            query = 'SELECT id, username FROM users WHERE id IN ({})'.format(get_placeholders(user_ids))
+            cursor.execute(query, user_ids)
 
-        # get timeslots
-        event['timeslot_ids'] = get_timeslots_records_id_by_eventid(app, event['id'], conn)
+            results = cursor.fetchall()
 
-        response.append(event)
+        return {result['id']: result['username'] for result in results}
 
-    return response
+    except Exception as e:
+        app.logger.exception(e)
+        abort(500)
+
+
+def get_venues_by_ids(app, venue_ids, conn):
+    try:
+        venues = reference_data.get(conn).venues_by_id
+        return {venue_id: venues[venue_id] for venue_id in set(venue_ids) if venue_id in venues}
+
+    except Exception as e:
+        app.logger.exception(e)
+        abort(500)
+
+
+def get_reservation_events_by_ids(app, event_ids, conn):
+    event_ids = list(set(event_ids))
+    try:
+        with conn.cursor() as cursor:
+            query = 'SELECT e.id, e.name, e.start_at, e.end_at, e.price, v.name AS venue_name' \
+                    ' FROM events e JOIN venues v ON v.id = e.venue_id' \
+                    ' WHERE e.id IN ({})'.format(get_placeholders(event_ids))
+            cursor.execute(query, event_ids)
+
+            results = cursor.fetchall()
+
+        return {event['id']: event for event in results}
+
+    except Exception as e:
+        app.logger.exception(e)
+        abort(500)
+
+
+def get_current_resvs_by_eventids(app, event_ids, conn):
+    event_ids = list(set(event_ids))
+    try:
+        with conn.cursor() as cursor:
+            query = 'SELECT event_id, current_resv FROM event_seat_counts' \
+                    ' WHERE event_id IN ({})'.format(get_placeholders(event_ids))
+            cursor.execute(query, event_ids)
+
+            current_resvs = {result['event_id']: result['current_resv'] for result in cursor.fetchall()}
+
+            # カウンタ行が無い場合はreservationsから集計する
+            missing = [event_id for event_id in event_ids if event_id not in current_resvs]
+            if missing:
+                query = 'SELECT event_id, SUM(num_of_resv) AS current_resv FROM reservations' \
+                        ' WHERE event_id IN ({}) GROUP BY event_id'.format(get_placeholders(missing))
+                cursor.execute(query, missing)
+
+                # SUMはDecimalで返るためintに戻す
+                for result in cursor.fetchall():
+                    current_resvs[result['event_id']] = int(result['current_resv'])
+
+        return current_resvs
+
+    except Exception as e:
+        app.logger.exception(e)
+        abort(500)
+
+
+def get_timeslots_records_ids_by_eventids(app, event_ids, conn):
+    event_ids = list(set(event_ids))
+    try:
+        with conn.cursor() as cursor:
+            query = 'SELECT id, event_id FROM timeslots WHERE event_id IN ({}) ORDER BY id'.format(
+                get_placeholders(event_ids))
+            cursor.execute(query, event_ids)
+
+            results = cursor.fetchall()
+
+        ids = dict()
+        for i in results:
+            ids.setdefault(i['event_id'], []).append(i['id'])
+
+        return ids
+
+    except Exception as e:
+        app.logger.exception(e)
+        abort(500)
 
 
 def get_user_by_username(app, username, conn):
@@ -247,14 +516,9 @@ def get_user(app, user_id, conn):
 
 
 def get_genres(app, conn):
+    """シリアライズ済みのJSONを返す"""
     try:
-        with conn.cursor() as cursor:
-            query = 'SELECT * FROM eventgenres'
-            cursor.execute(query, )
-
-            results = cursor.fetchall()
-
-        return results
+        return reference_data.get(conn).genres_json
 
     except Exception as e:
         app.logger.exception(e)
@@ -263,13 +527,7 @@ def get_genres(app, conn):
 
 def get_genre_by_id(app, genre_id, conn):
     try:
-        with conn.cursor() as cursor:
-            query = 'SELECT * FROM eventgenres WHERE id = %s'
-            cursor.execute(query, (genre_id,))
-
-            result = cursor.fetchone()
-
-        return result
+        return reference_data.get(conn).genres_by_id.get(genre_id)
 
     except Exception as e:
         app.logger.exception(e)
@@ -319,96 +577,151 @@ def get_reservation_by_id(app, resv_id, conn):
         abort(500)
 
 
-def get_reservations_by_eventid(app, event_id, conn, offset, limit):
+def has_reservation(app, user_id, event_id, conn):
+    """ユーザがイベントを予約済みか(reservationsの(event_id, user_id)のユニークインデックスで調べる)"""
     try:
         with conn.cursor() as cursor:
-            query = 'SELECT * FROM reservations WHERE event_id = %s LIMIT %s OFFSET %s'
-            cursor.execute(query, (event_id, limit, offset,))
-
-            reservations = cursor.fetchall()
-
-            if reservations is None:
-                return None
+            query = 'SELECT 1 FROM reservations WHERE event_id = %s AND user_id = %s LIMIT 1'
+            cursor.execute(query, (event_id, user_id))
 
-        return reservations
+            return cursor.fetchone() is not None
 
     except Exception as e:
         app.logger.exception(e)
         abort(500)
 
 
-def get_current_resv(app, event_id, conn):
+def get_reservations_by_eventid(app, event_id, conn, offset, limit, after_id=None):
+    """offsetがNoneの場合はid順に並べ，after_idより後ろを返す(カーソルによるページング)"""
     try:
         with conn.cursor() as cursor:
-            query = 'SELECT * FROM reservations WHERE event_id = %s'
-            cursor.execute(query, (event_id,))
+            if offset is None:
+                query = 'SELECT * FROM reservations WHERE event_id = %s AND id > %s ORDER BY id LIMIT %s'
+                cursor.execute(query, (event_id, after_id or 0, limit,))
+            else:
+                query = 'SELECT * FROM reservations WHERE event_id = %s LIMIT %s OFFSET %s'
+                cursor.execute(query, (event_id, limit, offset,))
 
-            results = cursor.fetchall()
-
-            curret_resv = 0
+            reservations = cursor.fetchall()
 
-            for result in results:
-                curret_resv += result['num_of_resv']
+            if reservations is None:
+                return None
 
-            return curret_resv
+        return reservations
 
     except Exception as e:
         app.logger.exception(e)
         abort(500)
 
 
-def get_timeslots_records_id_by_eventid(app, eventid, conn):
+def reserve(app, user_id, event_id, num_of_resv, capacity, conn):
+    """予約を1件登録し，reservation_queue.ReservationBatcher.submitと同じ形式で結果を返す"""
     try:
         with conn.cursor() as cursor:
-            query = 'SELECT * FROM timeslots WHERE event_id = %s'
-            cursor.execute(query, (eventid,))
 
-            results = cursor.fetchall()
-
-            ids = list()
-            for i in results:
-                ids.append(i['id'])
-
-        return ids
+            conn.begin()
+
+            # if user has already reserved (reservationsの(event_id, user_id)のユニーク制約で検出する)
+            query = "INSERT INTO reservations(user_id, event_id, num_of_resv)" + \
+                    " VALUES(%s, %s, %s)"
+
+            try:
+                cursor.execute(query, (user_id, event_id, num_of_resv,))
+            except pymysql.err.IntegrityError:
+                conn.rollback()
+                return reservation_queue.ALREADY_RESERVED, None
+
+            if cursor.rowcount != 1:
+                raise Exception
+
+            new_resv_id = cursor.lastrowid
+
+            # Will the capacity be exceeded by this booking?
+            # 対象イベントのカウンタ行だけがロックされる(他のイベントへの予約は並行して進められる)
+            current_resv = seat_counts.add(cursor, event_id, num_of_resv, capacity)
+            if current_resv is None:
+                current_resv = seat_counts.get(cursor, event_id)
+                if current_resv is not None:
+                    conn.rollback()
+                    mark_if_sold_out(event_id, current_resv, capacity)
+                    return reservation_queue.SOLD_OUT, None
+
+                # カウンタ行が無ければ作る．作った行はこの予約を含むので，もう一度足さずに確かめる
+                if seat_counts.ensure(cursor, [event_id]) == 1:
+                    current_resv = seat_counts.get(cursor, event_id)
+                    if current_resv > capacity:
+                        current_resv = None
+                else:
+                    current_resv = seat_counts.add(cursor, event_id, num_of_resv, capacity)
+                if current_resv is None:
+                    conn.rollback()
+                    return reservation_queue.SOLD_OUT, None
+
+            conn.commit()
+
+        mark_if_sold_out(event_id, current_resv, capacity)
+        return reservation_queue.RESERVED, new_resv_id
 
     except Exception as e:
+        conn.rollback()
         app.logger.exception(e)
         abort(500)
 
 
-def get_venues(app, conn, offset, limit):
+def mark_if_sold_out(event_id, current_resv, capacity):
+    # 満席になったら以降の予約はDBに問い合わせずに断る
+    if current_resv >= capacity:
+        sold_out_events.mark(event_id)
+
+
+def cancel_reservation(app, reservation_id, conn):
     try:
         with conn.cursor() as cursor:
-            query = 'SELECT * FROM venues LIMIT %s OFFSET %s'
-            cursor.execute(query, (limit, offset,))
 
-            results = cursor.fetchall()
+            conn.begin()
 
-            if results is None:
-                return None
+            query = 'SELECT event_id, num_of_resv FROM reservations WHERE id = %s FOR UPDATE'
+            cursor.execute(query, (reservation_id,))
+
+            reservation = cursor.fetchone()
+            if reservation is None:
+                conn.rollback()
+                return False
+
+            query = "DELETE FROM reservations WHERE id=%s"
+            cursor.execute(query, (reservation_id,))
+
+            seat_counts.add(cursor, reservation['event_id'], -reservation['num_of_resv'])
 
-            records = []
-            for result in results:
-                result['created_at'] = convert_to_iso8601(result['created_at'])
-                result['updated_at'] = convert_to_iso8601(result['updated_at'])
-                records.append(result)
+            conn.commit()
 
-        return records
+        # 空席ができたので全ワーカーの満席の記録を外す
+        sold_out_events.release(reservation['event_id'])
+
+        return True
 
     except Exception as e:
+        conn.rollback()
         app.logger.exception(e)
         abort(500)
 
 
-def get_venue_by_id(app, venue_id, conn):
+def get_venues(app, conn, offset, limit, after_id=None):
+    """(シリアライズ済みのJSON, ページ内の会場IDの一覧)を返す
+
+    会場はid順に並べる．offsetがNoneの場合はafter_idより後ろを返す(カーソルによるページング)
+    """
     try:
-        with conn.cursor() as cursor:
-            query = 'SELECT * FROM venues WHERE id = %s'
-            cursor.execute(query, (venue_id,))
+        return reference_data.venue_page(conn, offset, limit, after_id)
 
-            result = cursor.fetchone()
+    except Exception as e:
+        app.logger.exception(e)
+        abort(500)
 
-        return result
+
+def get_venue_by_id(app, venue_id, conn):
+    try:
+        return reference_data.get(conn).venues_by_id.get(venue_id)
 
     except Exception as e:
         app.logger.exception(e)
@@ -422,27 +735,7 @@ def get_venue_timeslots(app, venue_id, conn, from_=None, to=None):
         if to is None:
             to = get_last_date(dt.now())
 
-        with conn.cursor() as cursor:
-            query = 'SELECT * FROM timeslots WHERE venue_id = %s AND event_id IS NULL AND ' \
-                    '%s <= start_at AND start_at <= %s'
-            cursor.execute(query, (venue_id, from_, to,))
-
-            results = cursor.fetchall()
-
-            if results is None:
-                return None
-
-            records = []
-            for result in results:
-                result['start_at'] = convert_to_iso8601(result['start_at'])
-                result['end_at'] = convert_to_iso8601(result['end_at'])
-                result['created_at'] = convert_to_iso8601(result['created_at'])
-                result['updated_at'] = convert_to_iso8601(result['updated_at'])
-                result.pop('event_id')
-                result.pop('venue_id')
-                records.append(result)
-
-        return records
+        return timeslot_index.find(venue_id, from_, to, conn)
 
     except Exception as e:
         app.logger.exception(e)
@@ -450,6 +743,13 @@ def get_venue_timeslots(app, venue_id, conn, from_=None, to=None):
 
 
 def validatetimeslot(start_at, end_at, req_timeslot_ids, cursor):
+    # timeslots_idsで指定されたタイムスロットをid順にまとめてロックする(デッドロックを避ける)
+    query = 'SELECT * FROM timeslots WHERE id IN ({}) ORDER BY id FOR UPDATE'.format(
+        get_placeholders(req_timeslot_ids))
+    cursor.execute(query, req_timeslot_ids)
+
+    locked_timeslots = {timeslot['id']: timeslot for timeslot in cursor.fetchall()}
+
     # timeslots_idsで指定されたタイムスロット全ての開始/終了時刻を取得
     timeslots_begins = list()
     timeslots_ends = list()
@@ -457,10 +757,7 @@ def validatetimeslot(start_at, end_at, req_timeslot_ids, cursor):
     timeslots = list()
     for req_timeslot_id in req_timeslot_ids:
 
-        query = 'SELECT * FROM timeslots WHERE id = %s FOR UPDATE'
-        cursor.execute(query, (req_timeslot_id,))
-
-        timeslot = cursor.fetchone()
+        timeslot = locked_timeslots.get(req_timeslot_id)
 
         if timeslot is None:
             raise ValueError
@@ -492,3 +789,13 @@ def validatetimeslot(start_at, end_at, req_timeslot_ids, cursor):
         raise ValueError
 
     return timeslots
+
+
+def claim_timeslots(event_id, timeslot_ids, cursor):
+    """空いているタイムスロットを1つのUPDATEでまとめて確保する．1つでも確保できなければDuplicatedErrorを送出する"""
+    query = 'UPDATE timeslots SET event_id = %s WHERE id IN ({}) AND event_id IS NULL'.format(
+        get_placeholders(timeslot_ids))
+    cursor.execute(query, [event_id] + list(timeslot_ids))
+
+    if cursor.rowcount != len(timeslot_ids):
+        raise DuplicatedError